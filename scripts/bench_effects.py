@@ -0,0 +1,123 @@
+"""
+对比 setu 插件图片特效的 PIL 实现与 NumPy 实现。
+
+    python scripts/bench_effects.py --frames 30 --size 1620x1080
+
+两种实现使用相同的随机种子，输出中的 diff 为像素不一致的比例。
+第二张表对比 NumPy 实现逐张调用与 ``apply_effect_batch`` 一次处理整组帧。
+"""
+import sys
+import time
+import types
+import random
+import argparse
+import importlib
+from pathlib import Path
+
+import nonebot
+import numpy as np
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parent.parent
+PACKAGE = "src.plugins.nonebot_plugin_setu_now"
+
+
+def load_modules():
+    # 只加载特效相关的模块，不执行插件的 __init__（需要完整的 bot 环境）
+    nonebot.init()
+    for name in ("src", "src.plugins", PACKAGE):
+        module = types.ModuleType(name)
+        module.__path__ = [str(ROOT.joinpath(*name.split(".")))]
+        sys.modules[name] = module
+    img_utils = importlib.import_module(f"{PACKAGE}.img_utils")
+    effects_np = importlib.import_module(f"{PACKAGE}.effects_np")
+    return img_utils, effects_np
+
+
+def make_frames(count: int, size) -> list:
+    rng = np.random.default_rng(0)
+    return [
+        Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+        for _ in range(count)
+    ]
+
+
+def run(func, frames, seed: int):
+    random.seed(seed)
+    start = time.perf_counter()
+    result = [func(frame.copy()) for frame in frames]
+    return time.perf_counter() - start, result
+
+
+def run_batch(batch_func, frames, seed: int):
+    frames = [frame.copy() for frame in frames]
+    random.seed(seed)
+    start = time.perf_counter()
+    result = batch_func(frames)
+    return time.perf_counter() - start, result
+
+
+def compare(rows, left_name: str, right_name: str, frames, repeat: int) -> None:
+    print(f"{'effect':<16}{left_name:>10}{right_name:>10}{'speedup':>10}{'diff':>10}")
+    for name, left_func, right_func, right_runner in rows:
+        left_times, right_times = [], []
+        for seed in range(repeat):
+            left_time, left_result = run(left_func, frames, seed)
+            right_time, right_result = right_runner(right_func, frames, seed)
+            left_times.append(left_time)
+            right_times.append(right_time)
+        ratio = diff_ratio(left_result, right_result)
+        left_best, right_best = min(left_times), min(right_times)
+        print(
+            f"{name:<16}{left_best * 1000:>8.1f}ms{right_best * 1000:>8.1f}ms"
+            f"{left_best / right_best:>9.2f}x{ratio:>10.4%}"
+        )
+
+
+def diff_ratio(left, right) -> float:
+    total = differ = 0
+    for a, b in zip(left, right):
+        if a.size != b.size:
+            return 1.0
+        x, y = np.asarray(a), np.asarray(b)
+        differ += np.any(x != y, axis=-1).sum() if x.ndim == 3 else (x != y).sum()
+        total += a.width * a.height
+    return differ / total if total else 0.0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--size", default="1620x1080")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    size = tuple(int(i) for i in args.size.split("x"))
+
+    img_utils, effects_np = load_modules()
+    frames = make_frames(args.frames, size)
+    print(f"{args.frames} frames of {size[0]}x{size[1]}, best of {args.repeat}")
+    compare(
+        [
+            (name, img_utils.EFFECT_FUNCS[name], np_func, run)
+            for name, np_func in effects_np.EFFECT_FUNCS.items()
+        ],
+        "PIL",
+        "NumPy",
+        frames,
+        args.repeat,
+    )
+    print()
+    batch = lambda name: lambda frames: img_utils.apply_effect_batch(frames, name)
+    compare(
+        [
+            (name, effects_np.EFFECT_FUNCS[name], batch(name), run_batch)
+            for name in effects_np.BATCH_FUNCS
+        ],
+        "loop",
+        "batch",
+        frames,
+        args.repeat,
+    )
+
+if __name__ == "__main__":
+    main()
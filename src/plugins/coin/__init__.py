@@ -1,13 +1,17 @@
+import asyncio
+from typing import Optional
+
 from arclet.alconna import Args, Subcommand, Alconna, Arparma
 from nonebot_plugin_alconna import At, on_alconna
 from pydantic import BaseModel
-from nonebot import get_plugin_config
+from nonebot import get_driver, get_plugin_config
 from nonebot.log import logger
 from nonebot.plugin import PluginMetadata
 from nonebot.adapters.onebot.v11 import (
     MessageEvent,
 )
 from .coin_manager import CoinManager
+from .async_manager import AsyncCoinManager
 from .exceptions import CoinManagerException, InsufficientFundsException, TransferToSelfException
 
 from nonebot import require
@@ -42,6 +46,12 @@ class Config(BaseModel):
     superusers: set[str] = set("*")  # 用户ID列表，允许查询公网IP
     data_file: str = "data/coin/coin_data.json"  # 数据文件路径
     daily_check_in_bonus: int = 500  # 每日签到奖励
+    coin_backend: str = "file"  # file: JSON 文件; database: 与 setu 插件共用的 Tortoise ORM 数据库
+    coin_persist_mode: str = "snapshot"  # snapshot: 每次修改重写数据文件; journal: 追加日志并定期压缩; write_behind: 延迟批量写入
+    coin_journal_compact_threshold: int = 10000  # journal 模式下日志达到多少条时写快照
+    coin_flush_interval: float = 5.0  # write_behind 模式下最长写入间隔（秒）
+    coin_flush_threshold: int = 100  # write_behind 模式下脏用户达到多少个时立即写入
+    coin_rank_size: int = 10  # /c rank 显示的人数
 
 
 plugin_config = get_plugin_config(Config)
@@ -53,10 +63,57 @@ __plugin_meta__ = PluginMetadata(
     config=Config,
 )
 
-COIN_MANAGER = CoinManager(
-    data_file=plugin_config.data_file,
-    daily_check_in_bonus=plugin_config.daily_check_in_bonus
-)
+driver = get_driver()
+
+if plugin_config.coin_backend == "database":
+    require("nonebot_plugin_tortoise_orm")
+    from .db_manager import DatabaseCoinManager
+
+    COIN_MANAGER = DatabaseCoinManager(
+        daily_check_in_bonus=plugin_config.daily_check_in_bonus
+    )
+
+    @driver.on_startup
+    async def _():
+        await COIN_MANAGER.import_from_file(plugin_config.data_file)
+else:
+    COIN_MANAGER = AsyncCoinManager(
+        CoinManager(
+            data_file=plugin_config.data_file,
+            daily_check_in_bonus=plugin_config.daily_check_in_bonus,
+            persist_mode=plugin_config.coin_persist_mode,
+            journal_compact_threshold=plugin_config.coin_journal_compact_threshold,
+            flush_interval=plugin_config.coin_flush_interval,
+            flush_threshold=plugin_config.coin_flush_threshold,
+        )
+    )
+
+_flush_task: Optional[asyncio.Task] = None
+
+
+async def _flush_periodically():
+    # 没有新的修改时 _commit 不会被调用，由这里保证脏数据最迟在一个周期后写入
+    while True:
+        await asyncio.sleep(plugin_config.coin_flush_interval)
+        try:
+            await COIN_MANAGER.flush()
+        except Exception as e:
+            logger.error(f"Coin data flush failed: {e}")
+
+
+@driver.on_startup
+async def _():
+    global _flush_task
+    if plugin_config.coin_backend != "database" and plugin_config.coin_persist_mode == "write_behind":
+        _flush_task = asyncio.create_task(_flush_periodically())
+
+
+@driver.on_shutdown
+async def _():
+    if _flush_task is not None:
+        _flush_task.cancel()
+    await COIN_MANAGER.close()
+
 
 alc = Alconna(
     "/c",
@@ -72,6 +129,9 @@ alc = Alconna(
         Args["target?", At | str],    # 只有superuser可以查询其他用户余额
         # 如果没有提供target，则查询自己的余额
     ),
+    Subcommand(
+        "rank",
+    ),
     Subcommand(
         "help",
     )
@@ -87,10 +147,10 @@ async def _(result: Arparma, event: MessageEvent):
         await coin_cmd.finish(alc.get_help())
     if result.find("签到"):
         try:
-            coins = COIN_MANAGER.daily_check_in(str(event.get_user_id()))
+            coins = await COIN_MANAGER.daily_check_in(str(event.get_user_id()))
         except CoinManagerException as e:
             await coin_cmd.finish("你今天已经签到过了")
-        finally:
+        else:
             await coin_cmd.finish(f"签到成功！当前余额：{coins}")
     if result.find("t"):
         target = result.query("t.target")
@@ -102,9 +162,9 @@ async def _(result: Arparma, event: MessageEvent):
         from_user_id = str(event.get_user_id())
         logger.info(f"转账请求：{from_user_id} -> {target_id} 金额：{amount}")
         try:
-            ret = COIN_MANAGER.transfer(from_user_id, target_id, amount)
+            ret = await COIN_MANAGER.transfer(from_user_id, target_id, amount)
         except (TransferToSelfException, ValueError):
-            COIN_MANAGER.fine(from_user_id, 100)
+            await COIN_MANAGER.fine(from_user_id, 100)
             await coin_cmd.finish("你在做什么，没收你100明乃币！")
         except InsufficientFundsException:
             await coin_cmd.finish("你没有这么多明乃币！")
@@ -124,8 +184,21 @@ async def _(result: Arparma, event: MessageEvent):
         if target_id not in plugin_config.superusers and target_id != str(event.get_user_id()):
             await coin_cmd.finish("你没有权限查询其他用户的余额！")
 
-        balance = COIN_MANAGER.get_balance(target_id)
+        balance = await COIN_MANAGER.get_balance(target_id)
         await coin_cmd.finish(f"你还有{balance}个明乃币")
+    if result.find("rank"):
+        user_id = str(event.get_user_id())
+        top = await COIN_MANAGER.top(plugin_config.coin_rank_size)
+        if not top:
+            await coin_cmd.finish("还没有人拥有明乃币")
+        lines = ["明乃币排行榜："]
+        lines += [f"{i}. {uid}：{coins}" for i, (uid, coins) in enumerate(top, start=1)]
+        rank = await COIN_MANAGER.rank(user_id)
+        if rank is None:
+            lines.append("你还没有上榜")
+        else:
+            lines.append(f"你排在第{rank}名")
+        await coin_cmd.finish("\n".join(lines))
     if result.find("help"):
         await coin_cmd.finish(alc.get_help())
     await coin_cmd.finish(alc.get_help())
@@ -0,0 +1,86 @@
+import asyncio
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .coin_manager import CoinHold, CoinManager
+from .user_locks import UserLocks
+
+
+class AsyncCoinManager:
+    """
+    ``CoinManager`` 的协程接口，与 ``DatabaseCoinManager`` 保持一致，
+    使处理器无需关心具体使用哪种存储后端。
+
+    同一用户的操作按到达顺序串行执行（每个用户一把锁，没有全局锁）。
+    修改在事件循环中完成，磁盘写入放到线程中执行。
+    """
+
+    def __init__(self, manager: CoinManager):
+        self.manager = manager
+        # 磁盘写入由本类在线程中调用 persist 完成
+        self.manager.defer_io = True
+        self._locks = UserLocks()
+
+    async def _persist(self):
+        await asyncio.to_thread(self.manager.persist)
+
+    async def get_balance(self, user_id: str) -> int:
+        async with self._locks.acquire(user_id):
+            return self.manager.get_balance(user_id)
+
+    async def get_available_balance(self, user_id: str) -> int:
+        async with self._locks.acquire(user_id):
+            return self.manager.get_available_balance(user_id)
+
+    async def hold(self, user_id: str, amount: int) -> CoinHold:
+        # 预留只在内存中记账，不需要持久化
+        async with self._locks.acquire(user_id):
+            return self.manager.hold(user_id, amount)
+
+    async def settle(self, hold: CoinHold) -> int:
+        async with self._locks.acquire(hold.user_id):
+            coins = self.manager.settle(hold)
+            await self._persist()
+        return coins
+
+    async def top(self, n: int) -> List[Tuple[str, int]]:
+        return self.manager.top(n)
+
+    async def rank(self, user_id: str) -> Optional[int]:
+        return self.manager.rank(user_id)
+
+    async def modify_coins(self, user_id: str, amount: int) -> int:
+        async with self._locks.acquire(user_id):
+            coins = self.manager.modify_coins(user_id, amount)
+            await self._persist()
+        return coins
+
+    async def fine(self, user_id: str, amount: int) -> int:
+        async with self._locks.acquire(user_id):
+            coins = self.manager.fine(user_id, amount)
+            await self._persist()
+        return coins
+
+    async def daily_check_in(self, user_id: str) -> int:
+        async with self._locks.acquire(user_id):
+            coins = self.manager.daily_check_in(user_id)
+            await self._persist()
+        return coins
+
+    async def apply_many(self, operations: Iterable[Tuple[str, int]]) -> Dict[str, int]:
+        operations = list(operations)
+        async with self._locks.acquire(*(uid for uid, _ in operations)):
+            balances = self.manager.apply_many(operations)
+            await self._persist()
+        return balances
+
+    async def transfer(self, from_user_id: str, to_user_id: str, amount: int) -> Dict[str, int]:
+        async with self._locks.acquire(from_user_id, to_user_id):
+            ret = self.manager.transfer(from_user_id, to_user_id, amount)
+            await self._persist()
+        return ret
+
+    async def flush(self):
+        await asyncio.to_thread(self.manager.flush)
+
+    async def close(self):
+        await asyncio.to_thread(self.manager.close)
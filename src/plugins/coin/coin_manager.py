@@ -1,25 +1,111 @@
 import json
 import os
-from datetime import datetime, timedelta
-from typing import Dict
-from pydantic import BaseModel, Field, ValidationError
+import threading
+import time
+from array import array
+from datetime import date, datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
+from nonebot.log import logger
+from .leaderboard import Leaderboard
 from .exceptions import CoinManagerException, InsufficientFundsException, TransferToSelfException
 
 
-class UserAsset(BaseModel):
-    coins: int = Field(ge=0)
-    last_check_in: str | None = None  # ISO format date string, e.g., "2023-10-01T12:00:00"
+SNAPSHOT_VERSION = 2
+
+
+def _check_in_ordinal(last_check_in) -> int:
+    """把旧格式的 ISO 时间字符串转换为日期序号，0 表示从未签到"""
+    if not last_check_in:
+        return 0
+    if isinstance(last_check_in, int):
+        return last_check_in
+    return datetime.fromisoformat(last_check_in).date().toordinal()
+
+
+def ensure_valid_user_id(user_id: str):
+    if not isinstance(user_id, str) or not user_id.isalnum() or len(user_id) > 64:
+        raise ValueError("user_id must be an alphanumeric string up to 64 chars.")
+
+
+def ensure_amount_positive(amount: int):
+    if not isinstance(amount, int) or amount <= 0:
+        raise ValueError("amount must be a positive integer.")
+
+
+class CoinHold:
+    """
+    预留的明乃币。``capture`` 只在内存中记账，
+    由 ``settle`` 一次性扣除已 capture 的部分并释放其余预留。
+    """
+
+    def __init__(self, user_id: str, amount: int):
+        self.user_id = user_id
+        self.amount = amount
+        self.captured = 0
+        self.settled = False
+
+    @property
+    def remaining(self) -> int:
+        return self.amount - self.captured
+
+    def capture(self, amount: int):
+        if self.settled:
+            raise CoinManagerException("Hold has already been settled.")
+        if amount < 0 or amount > self.remaining:
+            raise InsufficientFundsException("Capture exceeds the held amount.")
+        self.captured += amount
+
 
 class CoinManager:
+    """
+    用户资产按列存放：``_index`` 把用户 ID 映射为下标，
+    余额与签到日期（``date.toordinal()``，0 表示从未签到）分别存放在紧凑数组中。
+
+    persist_mode:
+      * ``snapshot``: 每次修改后重写整个数据文件
+      * ``journal``: 每次修改只向日志文件追加被修改用户的记录，
+        日志条数达到 ``journal_compact_threshold`` 时写快照并清空日志
+      * ``write_behind``: 只标记被修改的用户，距上次写入超过 ``flush_interval`` 秒
+        或脏用户数达到 ``flush_threshold`` 时才写快照，退出前需调用 ``close``
+
+    ``defer_io`` 为真时修改只在内存中生效并登记待写入的内容，
+    由调用方（通常在线程中）调用 ``persist`` 完成磁盘写入。
+    """
+
     def __init__(
             self, 
             data_file: str = "data/coin/coin_data.json",
-            daily_check_in_bonus: int = 500
+            daily_check_in_bonus: int = 500,
+            persist_mode: str = "snapshot",
+            journal_compact_threshold: int = 10000,
+            flush_interval: float = 5.0,
+            flush_threshold: int = 100,
+            defer_io: bool = False,
         ):
+        if persist_mode not in ("snapshot", "journal", "write_behind"):
+            raise ValueError(f"Unknown persist mode: {persist_mode}")
         self.data_file = data_file
-        self.data: Dict[str, UserAsset] = {}
+        self.journal_file = data_file + ".journal"
+        self._index: Dict[str, int] = {}
+        self._user_ids: List[str] = []
+        self._coins = array("q")
+        self._check_in_days = array("i")
+        self._held: Dict[str, int] = {}  # 各用户被预留的明乃币，只存在于内存中
         self.daily_check_in_bonus = daily_check_in_bonus
+        self.persist_mode = persist_mode
+        self.journal_compact_threshold = journal_compact_threshold
+        self._journal: Optional[TextIO] = None
+        self._journal_entries = 0
+        self._pending_journal: List[str] = []
+        self._snapshot_due = False
+        self.defer_io = defer_io
+        self._io_lock = threading.RLock()
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._dirty: Set[str] = set()
+        self._last_flush = time.monotonic()
         self._load_data()
+        self._leaderboard = Leaderboard(zip(self._user_ids, self._coins))
 
     def _load_data(self):
         if not os.path.exists(os.path.dirname(self.data_file)):
@@ -27,73 +113,287 @@ class CoinManager:
         if os.path.exists(self.data_file):
             with open(self.data_file, "r") as f:
                 raw = json.load(f)
-                for uid, v in raw.items():
-                    try:
-                        self.data[uid] = UserAsset(**v)
-                    except ValidationError:
-                        self.data[uid] = UserAsset(coins=0, last_check_in=None)
+            if raw.get("version") == SNAPSHOT_VERSION:
+                self._load_columns(raw["users"], raw["coins"], raw["check_in_days"])
+            else:
+                self._load_legacy(raw)
         else:
             # 文件不存在时自动创建空文件
-            with open(self.data_file, "w") as f:
-                json.dump({}, f)
-            self.data = {}
+            self._save_data()
+        # 快照之后的修改记录在日志中，回放后立即压缩，保证下次启动的回放量有界
+        if self._replay_journal():
+            self.compact()
+
+    def _load_columns(self, users: List[str], coins: List[int], check_in_days: List[int]):
+        self._user_ids = users
+        self._index = dict(zip(users, range(len(users))))
+        self._coins = array("q", coins)
+        self._check_in_days = array("i", check_in_days)
+
+    def _load_legacy(self, raw: Dict[str, dict]):
+        """读取旧版 ``{uid: {"coins": ..., "last_check_in": ...}}`` 格式"""
+        for uid, v in raw.items():
+            idx = self._ensure_user(uid)
+            try:
+                coins = v["coins"]
+                if not isinstance(coins, int) or coins < 0:
+                    raise ValueError(coins)
+                self._coins[idx] = coins
+                self._check_in_days[idx] = _check_in_ordinal(v.get("last_check_in"))
+            except (KeyError, TypeError, ValueError):
+                self._coins[idx] = 0
+                self._check_in_days[idx] = 0
+
+    def _replay_journal(self) -> int:
+        if not os.path.exists(self.journal_file):
+            return 0
+        replayed = 0
+        with open(self.journal_file, "r") as f:
+            for line in f:
+                try:
+                    uid, coins, check_in_day = json.loads(line)
+                    check_in_day = _check_in_ordinal(check_in_day)
+                    idx = self._ensure_user(uid)
+                    self._coins[idx] = coins
+                    self._check_in_days[idx] = check_in_day
+                except (ValueError, TypeError, OverflowError):
+                    # 崩溃时最后一行可能只写了一半
+                    logger.warning(f"Skipped broken coin journal entry: {line!r}")
+                    continue
+                replayed += 1
+        logger.info(f"Replayed {replayed} coin journal entries")
+        return replayed
 
     def _save_data(self):
         dir_path = os.path.dirname(self.data_file)
         if not os.path.exists(dir_path):
             os.makedirs(dir_path, exist_ok=True)
-        with open(self.data_file, "w") as f:
-            json.dump({uid: asset.dict() for uid, asset in self.data.items()}, f, indent=4)
+        # persist 可能在线程中执行，此时事件循环仍可能追加新用户。
+        # _ensure_user 依次追加用户 ID、余额、签到日期，这里按相反顺序复制后截断到同一长度
+        check_in_days = self._check_in_days.tolist()
+        coins = self._coins.tolist()[:len(check_in_days)]
+        users = self._user_ids[:len(check_in_days)]
+        # 先写临时文件并落盘再替换，避免写到一半时崩溃导致快照损坏
+        tmp_file = self.data_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(
+                {
+                    "version": SNAPSHOT_VERSION,
+                    "users": users,
+                    "coins": coins,
+                    "check_in_days": check_in_days,
+                },
+                f,
+                separators=(",", ":"),
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.data_file)
+
+    def _write_journal(self):
+        lines, self._pending_journal = self._pending_journal, []
+        if not lines:
+            return
+        if self._journal is None:
+            self._journal = open(self.journal_file, "a")
+        self._journal.writelines(lines)
+        self._journal.flush()
+        self._journal_entries += len(lines)
+        if self._journal_entries >= self.journal_compact_threshold:
+            self._compact()
+
+    def _flush_dirty(self):
+        dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return
+        try:
+            self._save_data()
+        except Exception:
+            self._dirty.update(dirty)
+            raise
+        self._last_flush = time.monotonic()
+
+    def _commit(self, *user_ids: str):
+        """记录 ``user_ids`` 的修改，``defer_io`` 为假时立即持久化"""
+        if self.persist_mode == "journal":
+            for uid in user_ids:
+                idx = self._index[uid]
+                self._pending_journal.append(
+                    json.dumps([uid, self._coins[idx], self._check_in_days[idx]], separators=(",", ":")) + "\n"
+                )
+        elif self.persist_mode == "write_behind":
+            self._dirty.update(user_ids)
+        else:
+            self._snapshot_due = True
+        if not self.defer_io:
+            self.persist()
+
+    def persist(self, force: bool = False):
+        """
+        执行尚未完成的磁盘写入，可以在线程中调用。
+        ``force`` 为真时 write_behind 模式不等待间隔或阈值。
+        """
+        with self._io_lock:
+            if self.persist_mode == "journal":
+                self._write_journal()
+            elif self.persist_mode == "write_behind":
+                if (
+                    force
+                    or len(self._dirty) >= self.flush_threshold
+                    or time.monotonic() - self._last_flush >= self.flush_interval
+                ):
+                    self._flush_dirty()
+            elif self._snapshot_due:
+                self._snapshot_due = False
+                self._save_data()
+
+    def flush(self):
+        """立即写入所有尚未持久化的修改"""
+        self.persist(force=True)
+
+    def _compact(self):
+        self._save_data()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+        self._journal_entries = 0
+
+    def compact(self):
+        """写入完整快照并清空日志"""
+        with self._io_lock:
+            self._write_journal()
+            self._compact()
+
+    def close(self):
+        self.flush()
+        if self.persist_mode == "journal":
+            self.compact()
+
+    def _ensure_user(self, user_id: str) -> int:
+        idx = self._index.get(user_id)
+        if idx is None:
+            idx = len(self._user_ids)
+            self._user_ids.append(user_id)
+            self._coins.append(0)
+            self._check_in_days.append(0)
+            self._index[user_id] = idx
+        return idx
+
+    def _set_coins(self, idx: int, coins: int):
+        self._leaderboard.update(self._user_ids[idx], self._coins[idx], coins)
+        self._coins[idx] = coins
+
+    def iter_accounts(self) -> Iterator[Tuple[str, int, Optional[date]]]:
+        """依次返回 ``(user_id, coins, last_check_in)``"""
+        for uid, coins, day in zip(self._user_ids, self._coins, self._check_in_days):
+            yield uid, coins, date.fromordinal(day) if day else None
 
-    def _ensure_user(self, user_id: str):
-        if user_id not in self.data:
-            self.data[user_id] = UserAsset(coins=0, last_check_in=None)
-    
     def _ensure_valid_user_id(self, user_id: str):
-        if not isinstance(user_id, str) or not user_id.isalnum() or len(user_id) > 64:
-            raise ValueError("user_id must be an alphanumeric string up to 64 chars.")
-        
+        ensure_valid_user_id(user_id)
+
     def _ensure_amount_positive(self, amount: int):
-        if not isinstance(amount, int) or amount <= 0:
-            raise ValueError("amount must be a positive integer.")
+        ensure_amount_positive(amount)
 
     def get_balance(self, user_id: str) -> int:
         self._ensure_valid_user_id(user_id)
-        self._ensure_user(user_id)
-        return self.data[user_id].coins
+        idx = self._index.get(user_id)
+        return 0 if idx is None else self._coins[idx]
+
+    def get_available_balance(self, user_id: str) -> int:
+        """余额减去被预留的部分"""
+        return self.get_balance(user_id) - self._held.get(user_id, 0)
+
+    def hold(self, user_id: str, amount: int) -> CoinHold:
+        """预留 ``amount`` 明乃币，预留期间其他扣款不能动用这部分余额"""
+        self._ensure_valid_user_id(user_id)
+        if not isinstance(amount, int) or amount < 0:
+            raise ValueError("amount must be a non-negative integer.")
+        if self.get_available_balance(user_id) < amount:
+            raise InsufficientFundsException("Insufficient funds for hold.")
+        self._held[user_id] = self._held.get(user_id, 0) + amount
+        return CoinHold(user_id, amount)
+
+    def settle(self, hold: CoinHold) -> int:
+        """扣除已 capture 的部分并释放其余预留，返回新余额"""
+        if hold.settled:
+            return self.get_balance(hold.user_id)
+        hold.settled = True
+        held = self._held[hold.user_id] - hold.amount
+        if held:
+            self._held[hold.user_id] = held
+        else:
+            del self._held[hold.user_id]
+        if not hold.captured:
+            return self.get_balance(hold.user_id)
+        idx = self._ensure_user(hold.user_id)
+        # 罚款不受预留限制，余额可能已经不足
+        self._set_coins(idx, max(self._coins[idx] - hold.captured, 0))
+        self._commit(hold.user_id)
+        return self._coins[idx]
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        """余额最高的 ``n`` 个用户"""
+        return self._leaderboard.top(n)
+
+    def rank(self, user_id: str) -> Optional[int]:
+        """用户的名次，余额为 0 时返回 None"""
+        self._ensure_valid_user_id(user_id)
+        return self._leaderboard.rank(user_id, self.get_balance(user_id))
 
     def modify_coins(self, user_id: str, amount: int) -> int:
         self._ensure_valid_user_id(user_id)
-        self._ensure_user(user_id)
-        if amount < 0 and self.data[user_id].coins + amount < 0:
+        idx = self._ensure_user(user_id)
+        if amount < 0 and self.get_available_balance(user_id) + amount < 0:
             raise InsufficientFundsException("Insufficient funds: cannot have negative balance.")
-        self.data[user_id].coins += amount
-        self._save_data()
-        return self.data[user_id].coins
+        self._set_coins(idx, self._coins[idx] + amount)
+        self._commit(user_id)
+        return self._coins[idx]
     
     def fine(self, user_id: str, amount: int) -> int:
         self._ensure_valid_user_id(user_id)
         self._ensure_amount_positive(amount)
-        self._ensure_user(user_id)
-        if self.data[user_id].coins < amount:
-            self.data[user_id].coins = 0  # 如果余额不足，设置为0
-        self.data[user_id].coins -= amount
-        self._save_data()
-        return self.data[user_id].coins
+        idx = self._ensure_user(user_id)
+        # 如果余额不足，设置为0
+        self._set_coins(idx, max(self._coins[idx] - amount, 0))
+        self._commit(user_id)
+        return self._coins[idx]
 
     def daily_check_in(self, user_id: str) -> int:
         self._ensure_valid_user_id(user_id)
-        self._ensure_user(user_id)
-        last_check_in = self.data[user_id].last_check_in
-        today = datetime.now().date()
-        if last_check_in:
-            last_check_in_date = datetime.fromisoformat(last_check_in).date()
-            if last_check_in_date == today:
-                raise CoinManagerException("User has already checked in today.")
-        self.data[user_id].coins += self.daily_check_in_bonus  # Daily reward
-        self.data[user_id].last_check_in = datetime.now().isoformat()
-        self._save_data()
-        return self.data[user_id].coins
+        idx = self._ensure_user(user_id)
+        today = date.today().toordinal()
+        if self._check_in_days[idx] == today:
+            raise CoinManagerException("User has already checked in today.")
+        self._set_coins(idx, self._coins[idx] + self.daily_check_in_bonus)  # Daily reward
+        self._check_in_days[idx] = today
+        self._commit(user_id)
+        return self._coins[idx]
+
+    def apply_many(self, operations: Iterable[Tuple[str, int]]) -> Dict[str, int]:
+        """
+        原子地执行多笔 ``(user_id, amount)`` 增减，同一用户的多笔操作合并计算。
+        任一用户最终余额为负时不做任何修改，全部成功后只持久化一次。
+        返回涉及用户的新余额。
+        """
+        deltas: Dict[str, int] = {}
+        for user_id, amount in operations:
+            self._ensure_valid_user_id(user_id)
+            if not isinstance(amount, int):
+                raise ValueError("amount must be an integer.")
+            deltas[user_id] = deltas.get(user_id, 0) + amount
+        for user_id, delta in deltas.items():
+            if delta < 0 and self.get_available_balance(user_id) + delta < 0:
+                raise InsufficientFundsException(f"Insufficient funds for {user_id}.")
+        balances: Dict[str, int] = {}
+        for user_id, delta in deltas.items():
+            idx = self._ensure_user(user_id)
+            self._set_coins(idx, self._coins[idx] + delta)
+            balances[user_id] = self._coins[idx]
+        if deltas:
+            self._commit(*deltas)
+        return balances
 
     def transfer(self, from_user_id: str, to_user_id: str, amount: int) -> Dict[str, int]:
         self._ensure_valid_user_id(from_user_id)
@@ -101,15 +401,14 @@ class CoinManager:
         self._ensure_amount_positive(amount)
         if from_user_id == to_user_id:
             raise TransferToSelfException("Cannot transfer coins to oneself.")
-        self._ensure_user(from_user_id)
-        self._ensure_user(to_user_id)
-        if self.data[from_user_id].coins < amount:
+        from_idx = self._ensure_user(from_user_id)
+        to_idx = self._ensure_user(to_user_id)
+        if self.get_available_balance(from_user_id) < amount:
             raise InsufficientFundsException("Insufficient funds for transfer.")
-        self.data[from_user_id].coins -= amount
-        self.data[to_user_id].coins += amount
-        self._save_data()
+        self._set_coins(from_idx, self._coins[from_idx] - amount)
+        self._set_coins(to_idx, self._coins[to_idx] + amount)
+        self._commit(from_user_id, to_user_id)
         return {
-            "from_user_balance": self.data[from_user_id].coins,
-            "to_user_balance": self.data[to_user_id].coins
+            "from_user_balance": self._coins[from_idx],
+            "to_user_balance": self._coins[to_idx]
         }
-    
\ No newline at end of file
@@ -0,0 +1,185 @@
+import os
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from tortoise.expressions import Q
+from tortoise.transactions import in_transaction
+from nonebot.log import logger
+
+from .coin_manager import CoinHold, CoinManager, ensure_valid_user_id, ensure_amount_positive
+from .user_locks import UserLocks
+from .models import UserAssetRecord
+from .exceptions import CoinManagerException, InsufficientFundsException, TransferToSelfException
+
+
+class DatabaseCoinManager:
+    """
+    把用户资产存放在 Tortoise ORM 数据库中（与 setu 插件共用 ``tortoise_orm_db_url``），
+    接口与 ``AsyncCoinManager`` 一致，每个操作在单个事务中完成。
+    """
+
+    _ensure_valid_user_id = staticmethod(ensure_valid_user_id)
+    _ensure_amount_positive = staticmethod(ensure_amount_positive)
+
+    def __init__(self, daily_check_in_bonus: int = 500):
+        self.daily_check_in_bonus = daily_check_in_bonus
+        self._held: Dict[str, int] = {}  # 各用户被预留的明乃币，只存在于内存中
+        # 预留与扣款在同一把用户锁下检查余额，读取余额的 await 期间不会有扣款提交
+        self._locks = UserLocks()
+
+    async def import_from_file(self, data_file: str):
+        """数据库为空时导入 JSON 文件中的旧数据"""
+        if not os.path.exists(data_file) or await UserAssetRecord.exists():
+            return
+        manager = CoinManager(data_file=data_file)
+        records = [
+            UserAssetRecord(user_id=uid, coins=coins, last_check_in=last_check_in)
+            for uid, coins, last_check_in in manager.iter_accounts()
+        ]
+        async with in_transaction() as conn:
+            await UserAssetRecord.bulk_create(records, batch_size=1000, using_db=conn)
+        logger.info(f"Imported {len(records)} coin accounts from {data_file}")
+
+    @staticmethod
+    async def _lock_record(user_id: str, conn) -> UserAssetRecord:
+        record = (
+            await UserAssetRecord.select_for_update()
+            .using_db(conn)
+            .get_or_none(user_id=user_id)
+        )
+        if record is None:
+            record = await UserAssetRecord.create(user_id=user_id, coins=0, using_db=conn)
+        return record
+
+    async def get_balance(self, user_id: str) -> int:
+        self._ensure_valid_user_id(user_id)
+        record = await UserAssetRecord.get_or_none(user_id=user_id)
+        return record.coins if record else 0
+
+    async def get_available_balance(self, user_id: str) -> int:
+        return await self.get_balance(user_id) - self._held.get(user_id, 0)
+
+    async def hold(self, user_id: str, amount: int) -> CoinHold:
+        self._ensure_valid_user_id(user_id)
+        if not isinstance(amount, int) or amount < 0:
+            raise ValueError("amount must be a non-negative integer.")
+        async with self._locks.acquire(user_id):
+            if await self.get_available_balance(user_id) < amount:
+                raise InsufficientFundsException("Insufficient funds for hold.")
+            self._held[user_id] = self._held.get(user_id, 0) + amount
+        return CoinHold(user_id, amount)
+
+    async def settle(self, hold: CoinHold) -> int:
+        if hold.settled:
+            return await self.get_balance(hold.user_id)
+        hold.settled = True
+        held = self._held[hold.user_id] - hold.amount
+        if held:
+            self._held[hold.user_id] = held
+        else:
+            del self._held[hold.user_id]
+        if not hold.captured:
+            return await self.get_balance(hold.user_id)
+        async with self._locks.acquire(hold.user_id), in_transaction() as conn:
+            record = await self._lock_record(hold.user_id, conn)
+            # 罚款不受预留限制，余额可能已经不足
+            record.coins = max(record.coins - hold.captured, 0)
+            await record.save(using_db=conn, update_fields=["coins"])
+        return record.coins
+
+    async def top(self, n: int) -> List[Tuple[str, int]]:
+        return await (
+            UserAssetRecord.filter(coins__gt=0)
+            .order_by("-coins", "user_id")
+            .limit(n)
+            .values_list("user_id", "coins")
+        )
+
+    async def rank(self, user_id: str) -> Optional[int]:
+        coins = await self.get_balance(user_id)
+        if coins <= 0:
+            return None
+        # 与文件后端一致：余额相同时按用户 ID 排序
+        ahead = await UserAssetRecord.filter(
+            Q(coins__gt=coins) | Q(coins=coins, user_id__lt=user_id)
+        ).count()
+        return ahead + 1
+
+    async def modify_coins(self, user_id: str, amount: int) -> int:
+        self._ensure_valid_user_id(user_id)
+        async with self._locks.acquire(user_id), in_transaction() as conn:
+            record = await self._lock_record(user_id, conn)
+            if amount < 0 and record.coins - self._held.get(user_id, 0) + amount < 0:
+                raise InsufficientFundsException("Insufficient funds: cannot have negative balance.")
+            record.coins += amount
+            await record.save(using_db=conn, update_fields=["coins"])
+        return record.coins
+
+    async def fine(self, user_id: str, amount: int) -> int:
+        self._ensure_valid_user_id(user_id)
+        self._ensure_amount_positive(amount)
+        async with in_transaction() as conn:
+            record = await self._lock_record(user_id, conn)
+            # 如果余额不足，设置为0
+            record.coins = max(record.coins - amount, 0)
+            await record.save(using_db=conn, update_fields=["coins"])
+        return record.coins
+
+    async def daily_check_in(self, user_id: str) -> int:
+        self._ensure_valid_user_id(user_id)
+        today = date.today()
+        async with in_transaction() as conn:
+            record = await self._lock_record(user_id, conn)
+            if record.last_check_in == today:
+                raise CoinManagerException("User has already checked in today.")
+            record.coins += self.daily_check_in_bonus  # Daily reward
+            record.last_check_in = today
+            await record.save(using_db=conn, update_fields=["coins", "last_check_in"])
+        return record.coins
+
+    async def apply_many(self, operations: Iterable[Tuple[str, int]]) -> Dict[str, int]:
+        deltas: Dict[str, int] = {}
+        for user_id, amount in operations:
+            self._ensure_valid_user_id(user_id)
+            if not isinstance(amount, int):
+                raise ValueError("amount must be an integer.")
+            deltas[user_id] = deltas.get(user_id, 0) + amount
+        async with self._locks.acquire(*deltas), in_transaction() as conn:
+            records = {uid: await self._lock_record(uid, conn) for uid in sorted(deltas)}
+            for uid, delta in deltas.items():
+                if delta < 0 and records[uid].coins - self._held.get(uid, 0) + delta < 0:
+                    raise InsufficientFundsException(f"Insufficient funds for {uid}.")
+            for uid, delta in deltas.items():
+                records[uid].coins += delta
+                await records[uid].save(using_db=conn, update_fields=["coins"])
+        return {uid: record.coins for uid, record in records.items()}
+
+    async def transfer(self, from_user_id: str, to_user_id: str, amount: int) -> Dict[str, int]:
+        self._ensure_valid_user_id(from_user_id)
+        self._ensure_valid_user_id(to_user_id)
+        self._ensure_amount_positive(amount)
+        if from_user_id == to_user_id:
+            raise TransferToSelfException("Cannot transfer coins to oneself.")
+        async with self._locks.acquire(from_user_id, to_user_id), in_transaction() as conn:
+            # 按固定顺序加锁，避免两个方向相反的转账互相等待
+            records = {
+                uid: await self._lock_record(uid, conn)
+                for uid in sorted((from_user_id, to_user_id))
+            }
+            from_record, to_record = records[from_user_id], records[to_user_id]
+            if from_record.coins - self._held.get(from_user_id, 0) < amount:
+                raise InsufficientFundsException("Insufficient funds for transfer.")
+            from_record.coins -= amount
+            to_record.coins += amount
+            await from_record.save(using_db=conn, update_fields=["coins"])
+            await to_record.save(using_db=conn, update_fields=["coins"])
+        return {
+            "from_user_balance": from_record.coins,
+            "to_user_balance": to_record.coins
+        }
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
@@ -0,0 +1,89 @@
+from bisect import bisect_left, insort
+from typing import Iterable, List, Optional, Tuple
+
+
+class Leaderboard:
+    """
+    按余额从高到低排列的分桶有序表，只收录余额大于 0 的用户。
+
+    元素为 ``(-coins, user_id)``，存放在若干个长度不超过 ``2 * LOAD`` 的有序桶中，
+    插入和删除只移动一个桶内的元素，排名查询只需累加前面各桶的长度。
+    """
+
+    LOAD = 1000
+
+    def __init__(self, accounts: Iterable[Tuple[str, int]] = ()):
+        keys = sorted((-coins, uid) for uid, coins in accounts if coins > 0)
+        self._lists: List[List[Tuple[int, str]]] = [
+            keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)
+        ]
+        self._maxes: List[Tuple[int, str]] = [lst[-1] for lst in self._lists]
+        self._len = len(keys)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _add(self, key: Tuple[int, str]):
+        if not self._maxes:
+            self._lists.append([key])
+            self._maxes.append(key)
+        else:
+            pos = bisect_left(self._maxes, key)
+            if pos == len(self._maxes):
+                pos -= 1
+                self._lists[pos].append(key)
+                self._maxes[pos] = key
+            else:
+                insort(self._lists[pos], key)
+            lst = self._lists[pos]
+            if len(lst) > 2 * self.LOAD:
+                half = lst[self.LOAD:]
+                del lst[self.LOAD:]
+                self._maxes[pos] = lst[-1]
+                self._lists.insert(pos + 1, half)
+                self._maxes.insert(pos + 1, half[-1])
+        self._len += 1
+
+    def _discard(self, key: Tuple[int, str]):
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            return
+        lst = self._lists[pos]
+        idx = bisect_left(lst, key)
+        if idx == len(lst) or lst[idx] != key:
+            return
+        del lst[idx]
+        if lst:
+            self._maxes[pos] = lst[-1]
+        else:
+            del self._lists[pos]
+            del self._maxes[pos]
+        self._len -= 1
+
+    def update(self, user_id: str, old_coins: int, new_coins: int):
+        if old_coins == new_coins:
+            return
+        if old_coins > 0:
+            self._discard((-old_coins, user_id))
+        if new_coins > 0:
+            self._add((-new_coins, user_id))
+
+    def rank(self, user_id: str, coins: int) -> Optional[int]:
+        """从 1 开始的名次，余额为 0 的用户不参与排名"""
+        if coins <= 0:
+            return None
+        key = (-coins, user_id)
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            return None
+        idx = bisect_left(self._lists[pos], key)
+        return sum(len(lst) for lst in self._lists[:pos]) + idx + 1
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        result: List[Tuple[str, int]] = []
+        for lst in self._lists:
+            for neg_coins, uid in lst[:n - len(result)]:
+                result.append((uid, -neg_coins))
+            if len(result) >= n:
+                break
+        return result
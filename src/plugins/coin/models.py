@@ -0,0 +1,15 @@
+from tortoise import fields
+from tortoise.models import Model
+from nonebot_plugin_tortoise_orm import add_model
+
+
+add_model(__name__)
+
+
+class UserAssetRecord(Model):
+    user_id = fields.CharField(pk=True, max_length=64)
+    coins = fields.IntField(default=0, index=True)
+    last_check_in = fields.DateField(null=True)
+
+    class Meta:
+        table = "coin_user_asset"
@@ -0,0 +1,29 @@
+import asyncio
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import AsyncIterator
+from weakref import WeakValueDictionary
+
+
+class UserLocks:
+    """
+    每个用户一把 ``asyncio.Lock``，``AsyncCoinManager`` 与 ``DatabaseCoinManager`` 共用。
+
+    持有锁的协程保存着强引用，锁在无人使用后自动回收。
+    """
+
+    def __init__(self) -> None:
+        self._locks: "WeakValueDictionary[str, asyncio.Lock]" = WeakValueDictionary()
+
+    @asynccontextmanager
+    async def acquire(self, *user_ids: str) -> AsyncIterator[None]:
+        locks = []
+        # 按固定顺序加锁，两个用户同时互相转账时不会死锁
+        for uid in sorted(set(user_ids)):
+            lock = self._locks.get(uid)
+            if lock is None:
+                lock = self._locks[uid] = asyncio.Lock()
+            locks.append(lock)
+        async with AsyncExitStack() as stack:
+            for lock in locks:
+                await stack.enter_async_context(lock)
+            yield
@@ -11,9 +11,8 @@ from re import I, sub
 from typing import Any, Union, Annotated
 from pathlib import Path
 import os
-import httpx
 from PIL import UnidentifiedImageError
-from nonebot import on_regex, on_command
+from nonebot import on_regex, get_driver, on_command
 from nonebot.log import logger
 from nonebot.params import Depends, RegexGroup
 from nonebot.plugin import PluginMetadata
@@ -34,16 +33,23 @@ from nonebot.adapters.onebot.v11.helpers import (
     autorevoke_send,
 )
 
-from .utils import SpeedLimiter
-from .config import MAX, CDTIME, EFFECT, SETU_PATH, WITHDRAW_TIME, Config, EXCLUDEAI, REPO_BASE_URL
+from .utils import SpeedLimiter, download_pic, wait_background_writes
+from .config import MAX, PROXY, CDTIME, EFFECT, SETU_PATH, WITHDRAW_TIME, Config, EXCLUDEAI, REPO_BASE_URL
 from .models import Setu, SetuNotFindError
 from .database import SetuInfo, MessageInfo, bind_message_data, auto_update_setuinfo
-from .img_utils import EFFECT_FUNC_LIST, image_segment_convert
+from .img_utils import EFFECT_FUNC_LIST, DecodedImage
+from .image_engine import IMAGE_ENGINE
 from .perf_timer import PerfTimer
-from .data_source import SetuHandler
+from .data_source import PREFETCH_POOL, SetuHandler
+from .http_client import CLIENT_MANAGER
+from .file_cache import IMAGE_CACHE
+from .dedupe import DEDUPE_INDEX
+from .file_server import FILE_SERVER
+from .variant_cache import VARIANT_CACHE, load_variant, store_variant, variant_name
 from .r18_whitelist import get_group_white_list_record
 
 from ..coin import COIN_MANAGER
+from ..coin.exceptions import InsufficientFundsException
 
 from nonebot.matcher import Matcher
 from nonebot.adapters.onebot.v11 import MessageSegment
@@ -86,6 +92,33 @@ if SETU_PATH:
 
 global_speedlimiter = SpeedLimiter()
 
+driver = get_driver()
+
+# 在事件循环和其他线程启动之前 fork 出图片处理子进程
+IMAGE_ENGINE.start()
+
+
+@driver.on_startup
+async def _():
+    CLIENT_MANAGER.get(PROXY)
+    FILE_SERVER.start()
+    if not REPO_BASE_URL:
+        # 配置了本地图库时普通请求由图库提供，只有 R18 请求会用到预取池
+        PREFETCH_POOL.schedule_refill(False, EXCLUDEAI)
+
+
+@driver.on_shutdown
+async def _():
+    await PREFETCH_POOL.aclose()
+    await CLIENT_MANAGER.aclose()
+    await FILE_SERVER.aclose()
+    await wait_background_writes()
+    IMAGE_ENGINE.shutdown()
+    if IMAGE_CACHE is not None:
+        IMAGE_CACHE.save_index()
+    if VARIANT_CACHE is not None:
+        VARIANT_CACHE.save_index()
+
 # TODO: 不要用regex辣
 setu_matcher = on_regex(
     r"^(setu|色图|涩图|来点色色|色色|涩涩|来点色图)\s?([x|✖️|×|X|*]?\d+[张|个|份]?)?\s?(r18)?\s?\s?(tag)?\s?(.*)?",
@@ -111,11 +144,6 @@ async def _(
     white_list_record=Depends(get_group_white_list_record),
 ):
     random_cost = random.randint(0, 100)
-    if COIN_MANAGER.get_balance(str(event.get_user_id())) < random_cost:
-        await setu_matcher.finish(
-            "你的明乃币不足，无法获取色图喵\n请使用 /c 签到 获取明乃币"
-        )
-        return
     # await setu_matcher.finish("服务器维护喵，暂停服务抱歉喵")
     setu_total_timer = PerfTimer("Image request total")
     args = list(regex_group)
@@ -150,7 +178,20 @@ async def _(
 
     logger.debug(f"Setu: r18:{r18}, tag:{tags}, key:{key}, num:{num}")
 
+    # 一次预留全部费用，每张图发送成功后从预留中记账，请求结束时统一结算
+    try:
+        hold = await COIN_MANAGER.hold(str(event.get_user_id()), num * random_cost)
+    except InsufficientFundsException:
+        await setu_matcher.finish(
+            "你的明乃币不足，无法获取色图喵\n请使用 /c 签到 获取明乃币"
+        )
+
     failure_msg = 0
+    # 去重按群进行，私聊按用户进行
+    if isinstance(event, GroupMessageEvent):
+        group_key = f"group_{event.group_id}"
+    else:
+        group_key = f"private_{event.get_user_id()}"
 
     async def nb_send_handler(setu: Setu) -> None:
         nonlocal failure_msg, random_cost
@@ -158,6 +199,7 @@ async def _(
             logger.warning("Invalid image type, skipped")
             failure_msg += 1
             return
+        decoded = DecodedImage(setu.img, key=None if setu.is_local else setu.pid)
         for process_func in EFFECT_FUNC_LIST:
             if r18 and process_func == EFFECT_FUNC_LIST[0]:
                 # R18禁止使用默认图像处理方法(do_nothing)
@@ -165,15 +207,21 @@ async def _(
             # if process_func == EFFECT_FUNC_LIST[0]:
             #     continue
             logger.debug(f"Using effect {process_func}")
-            effert_timer = PerfTimer.start("Effect process")
-            try:
-                image = process_func(setu.img)  # type: ignore
-            except UnidentifiedImageError:
-                logger.warning(f"Unidentified image: {type(setu.img)}")
-                failure_msg += 1
-                return
-            effert_timer.stop()
-            msg = MessageSegment.reply(event.message_id) + Message(image_segment_convert(image)) + MessageSegment.text(f"你花了{random_cost}明乃币得到了色图")
+            variant = variant_name(setu, process_func)
+            image = await load_variant(variant)
+            if image is not None:
+                logger.debug(f"Variant cache hit: {variant}")
+                variant = None  # 已经在缓存中，发送成功后无需再保存
+            else:
+                effert_timer = PerfTimer.start("Effect process")
+                try:
+                    image = await IMAGE_ENGINE.render(decoded, process_func)
+                except UnidentifiedImageError:
+                    logger.warning(f"Unidentified image: {type(setu.img)}")
+                    failure_msg += 1
+                    return
+                effert_timer.stop()
+            msg = MessageSegment.reply(event.message_id) + Message(await FILE_SERVER.segment(image)) + MessageSegment.text(f"你花了{random_cost}明乃币得到了色图")
             try:
                 await global_speedlimiter.async_speedlimit()
                 send_timer = PerfTimer("Image send")
@@ -193,11 +241,20 @@ async def _(
                 """
                 发送成功
                 """
-                COIN_MANAGER.modify_coins(str(event.get_user_id()), -random_cost)  # 扣除明乃币
+                hold.capture(random_cost)
                 send_timer.stop()
                 global_speedlimiter.send_success()
-                if SETU_PATH is None or setu.is_local:  # 未设置缓存路径，删除缓存
-                    Path(setu.img).unlink()
+                if isinstance(image, bytes):
+                    store_variant(variant, image)
+                if setu.dhash is not None:
+                    DEDUPE_INDEX.add(group_key, setu.dhash)
+                # 未启用图片缓存且未设置缓存路径，删除图片；内存中的图片无需处理
+                if (
+                    isinstance(setu.img, Path)
+                    and IMAGE_CACHE is None
+                    and (SETU_PATH is None or setu.is_local)
+                ):
+                    setu.img.unlink()
                 return
             except ActionFailed:
                 if not EFFECT:  # 设置不允许添加特效
@@ -207,18 +264,35 @@ async def _(
                 logger.warning("Image send failed, retrying another effect")
         failure_msg += 1
         logger.warning("Image send failed after tried all effects")
-        if SETU_PATH is None:  # 未设置缓存路径，删除缓存
-            Path(setu.img).unlink()
-
-    setu_handler = SetuHandler(key, tags, r18, num, nb_send_handler, EXCLUDEAI)
+        # 未设置缓存路径，删除缓存
+        if isinstance(setu.img, Path) and IMAGE_CACHE is None and SETU_PATH is None:
+            setu.img.unlink()
+
+    setu_handler = SetuHandler(
+        key,
+        tags,
+        r18,
+        num,
+        nb_send_handler,
+        EXCLUDEAI,
+        str(event.get_user_id()),
+        group_key,
+    )
     try:
         await setu_handler.process_request()
     except SetuNotFindError:
         await setu_matcher.finish(f"没有找到关于 {tags or key} 的色图喵")
+    finally:
+        await COIN_MANAGER.settle(hold)  # 扣除明乃币
     if failure_msg:
         await setu_matcher.send(
             message=Message(f"{failure_msg} 张图片消失了喵"),
         )
+    if setu_handler.dropped:
+        # 被去重的图片没有发送，也就没有扣除明乃币
+        await setu_matcher.send(
+            message=Message(f"{setu_handler.dropped} 张图片最近发过了，已跳过喵，没有扣除明乃币"),
+        )
     setu_total_timer.stop()
 
 
@@ -310,7 +384,7 @@ async def _(
         setu_info.rates[user_id] = rate
         await setu_info.save()
         bonus = random.randint(1, 30)
-        COIN_MANAGER.modify_coins(str(event.get_user_id()), bonus)
+        await COIN_MANAGER.modify_coins(str(event.get_user_id()), bonus)
         await rate_matcher.finish(f"成功评分{rate}分，奖励你{bonus}明乃币喵~")
     else:
         await rate_matcher.finish("该插画相关信息已被移除")
@@ -342,16 +416,24 @@ async def _(
 
     if setu_info := await SetuInfo.get_or_none(pid=message_pid):
         pid = setu_info.pid
-        filepath = next(Path(SETU_PATH).glob(f"{pid}.*"), None)
+        filepath = next(
+            (i for i in Path(SETU_PATH).glob(f"{pid}.*") if i.suffix != ".part"), None
+        )
+        if filepath is None:
+            # 图片缓存可能已经清理了这张图，按记录的地址重新下载
+            ext = setu_info.url.rsplit(".", 1)[-1]
+            filepath = await download_pic(
+                url=setu_info.url, proxy=PROXY, file_name=f"{pid}.{ext}"
+            )
         if filepath is None:
             await collect_matcher.finish("未找到该插画文件")
-        async with httpx.AsyncClient() as client:
-            with open(filepath, "rb") as f:
-                files = {'files': (str(filepath), f, 'image/jpeg')}
-                response = await client.post(
-                    f"{REPO_BASE_URL}/upload",
-                    files=files,
-                )
+        client = CLIENT_MANAGER.get()
+        with open(filepath, "rb") as f:
+            files = {'files': (str(filepath), f, 'image/jpeg')}
+            response = await client.post(
+                f"{REPO_BASE_URL}/upload",
+                files=files,
+            )
         if response.status_code == 200:
             await collect_matcher.finish("已收收录进明乃的涩图站~")
         else:
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from nonebot import get_plugin_config
-from typing import Set
+from typing import Set, List
 
 
 class Config(BaseModel):
@@ -19,6 +19,32 @@ class Config(BaseModel):
     setu_send_as_bytes: bool = True
     setu_excludeAI: bool = False
     setu_repo_base_url: str = ""
+    setu_http2: bool = False
+    setu_max_connections: int = 32
+    setu_max_keepalive_connections: int = 16
+    setu_keepalive_expiry: float = 30
+    setu_prefetch_size: int = 10
+    setu_query_cache_ttl: int = 300
+    setu_query_negative_ttl: int = 600
+    setu_query_cache_size: int = 256
+    setu_image_cache_max_bytes: int = 1024 * 1024 * 1024  # 0 为不启用
+    setu_repo_list_ttl: int = 300
+    setu_download_to_memory: bool = True
+    setu_download_concurrency: int = 8
+    setu_download_per_host: int = 4
+    setu_download_bandwidth: int = 0  # 字节/秒，0 为不限制
+    setu_reverse_proxy_mirrors: List[str] = []
+    setu_hedge_requests: bool = False
+    setu_image_workers: int = 0  # 0 为使用线程池
+    setu_variant_cache_max_bytes: int = 256 * 1024 * 1024
+    setu_numpy_effects: bool = False
+    setu_dedupe_window: int = 0  # 秒，0 为不去重；开启后每张图片发送前要先下载缩略图
+    setu_dedupe_distance: int = 6
+    setu_max_image_bytes: int = 0  # 0 为不限制发送图片的大小
+    setu_allow_webp: bool = False
+    setu_file_send_mode: str = "base64"  # base64 / url / file
+    setu_serve_base_url: str = ""
+    setu_serve_ttl: int = 300
 
 
 plugin_config = get_plugin_config(Config)
@@ -34,4 +60,31 @@ EFFECT = plugin_config.setu_add_random_effect
 SEND_INTERVAL = plugin_config.setu_minimum_send_interval
 SEND_AS_BYTES = plugin_config.setu_send_as_bytes
 EXCLUDEAI = plugin_config.setu_excludeAI
-REPO_BASE_URL = plugin_config.setu_repo_base_url
\ No newline at end of file
+REPO_BASE_URL = plugin_config.setu_repo_base_url
+HTTP2 = plugin_config.setu_http2
+MAX_CONNECTIONS = plugin_config.setu_max_connections
+MAX_KEEPALIVE_CONNECTIONS = plugin_config.setu_max_keepalive_connections
+KEEPALIVE_EXPIRY = plugin_config.setu_keepalive_expiry
+PREFETCH_SIZE = plugin_config.setu_prefetch_size
+QUERY_CACHE_TTL = plugin_config.setu_query_cache_ttl
+QUERY_NEGATIVE_TTL = plugin_config.setu_query_negative_ttl
+QUERY_CACHE_SIZE = plugin_config.setu_query_cache_size
+IMAGE_CACHE_MAX_BYTES = plugin_config.setu_image_cache_max_bytes
+REPO_LIST_TTL = plugin_config.setu_repo_list_ttl
+# 仅在以 bytes 发送图片时才有意义，否则仍需要落盘后按路径发送
+DOWNLOAD_TO_MEMORY = plugin_config.setu_download_to_memory and SEND_AS_BYTES
+DOWNLOAD_CONCURRENCY = plugin_config.setu_download_concurrency
+DOWNLOAD_PER_HOST = plugin_config.setu_download_per_host
+DOWNLOAD_BANDWIDTH = plugin_config.setu_download_bandwidth
+REVERSE_PROXY_MIRRORS = plugin_config.setu_reverse_proxy_mirrors
+HEDGE_REQUESTS = plugin_config.setu_hedge_requests
+IMAGE_WORKERS = plugin_config.setu_image_workers
+VARIANT_CACHE_MAX_BYTES = plugin_config.setu_variant_cache_max_bytes
+NUMPY_EFFECTS = plugin_config.setu_numpy_effects
+DEDUPE_WINDOW = plugin_config.setu_dedupe_window
+DEDUPE_DISTANCE = plugin_config.setu_dedupe_distance
+MAX_IMAGE_BYTES = plugin_config.setu_max_image_bytes
+ALLOW_WEBP = plugin_config.setu_allow_webp
+FILE_SEND_MODE = plugin_config.setu_file_send_mode
+SERVE_BASE_URL = plugin_config.setu_serve_base_url
+SERVE_TTL = plugin_config.setu_serve_ttl
\ No newline at end of file
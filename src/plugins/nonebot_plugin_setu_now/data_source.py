@@ -3,12 +3,29 @@ from asyncio import gather
 from pathlib import Path
 
 import nonebot_plugin_localstore as store
-from httpx import AsyncClient
 from nonebot.log import logger
 
-from .utils import download_pic, fetch_local_pic
-from .config import PROXY, API_URL, SETU_SIZE, REVERSE_PROXY, REPO_BASE_URL
+from .utils import download_pic
+from .http_client import CLIENT_MANAGER
+from .config import (
+    PROXY,
+    API_URL,
+    SETU_PATH,
+    SETU_SIZE,
+    PREFETCH_SIZE,
+    REVERSE_PROXY,
+    REPO_BASE_URL,
+    DOWNLOAD_TO_MEMORY,
+    QUERY_CACHE_TTL,
+    QUERY_CACHE_SIZE,
+    QUERY_NEGATIVE_TTL,
+)
 from .models import Setu, SetuApiData, SetuNotFindError
+from .prefetch import PrefetchPool
+from .query_cache import QueryCache
+from .repo_source import REPO_SOURCE
+from .file_cache import IMAGE_CACHE, discard_image
+from .dedupe import HASH_SIZE, DEDUPE_INDEX, fetch_dhash, drop_near_duplicates
 
 CACHE_PATH = Path(store.get_cache_dir("nonebot_plugin_setu_now"))
 if not CACHE_PATH.exists():
@@ -16,7 +33,44 @@ if not CACHE_PATH.exists():
     CACHE_PATH.mkdir(parents=True, exist_ok=True)
 
 
+async def fetch_setu_list(
+    key: str, tags: List[str], r18: bool, num: int, excludeAI: bool = False
+) -> List[Setu]:
+    data = {
+        "keyword": key,
+        "tag": tags,
+        "r18": r18,
+        "proxy": REVERSE_PROXY,
+        "num": num,
+        # 去重需要额外的缩略图地址
+        "size": [SETU_SIZE, HASH_SIZE] if DEDUPE_INDEX.enabled else SETU_SIZE,
+        "excludeAI": excludeAI,
+    }
+    headers = {"Content-Type": "application/json"}
+
+    client = CLIENT_MANAGER.get(PROXY)
+    res = await client.post(API_URL, json=data, headers=headers, timeout=60)
+    data = res.json()
+    setu_api_data_instance = SetuApiData(**data)
+    if len(setu_api_data_instance.data) == 0:
+        raise SetuNotFindError()
+    logger.debug(f"API Responsed {len(setu_api_data_instance.data)} image")
+    return [Setu(data=i) for i in setu_api_data_instance.data]
+
+
+async def fetch_untagged_setu_list(r18: bool, excludeAI: bool, num: int) -> List[Setu]:
+    return await fetch_setu_list("", [], r18, num, excludeAI)
+
+
+PREFETCH_POOL = PrefetchPool(PREFETCH_SIZE, fetch_untagged_setu_list)
+QUERY_CACHE = QueryCache(
+    fetch_setu_list, QUERY_CACHE_TTL, QUERY_NEGATIVE_TTL, QUERY_CACHE_SIZE
+)
+
+
 class SetuHandler:
+    DEDUPE_RETRIES = 2  # 去重后补图的最多轮数
+
     def __init__(
         self,
         key: str,
@@ -25,10 +79,12 @@ class SetuHandler:
         num: int,
         handler: Callable,
         excludeAI: bool = False,
+        user_id: str = "",
+        group_key: str = "",
     ) -> None:
         self.key = key
         self.tags = tags
-        self.r18 = r18
+        self.r18 = bool(r18)  # 正则未匹配到 r18 时为 None，与预取池的键保持一致
         self.num = num
         self.api_url = API_URL
         self.size = SETU_SIZE
@@ -37,30 +93,14 @@ class SetuHandler:
         self.handler = handler
         self.setu_instance_list: List[Setu] = []
         self.excludeAI = excludeAI
+        self.user_id = user_id
+        self.group_key = group_key
+        self.dropped = 0  # 因与近期发过的图片相近而没能补足的张数
 
     async def refresh_api_info(self):
-        data = {
-            "keyword": self.key,
-            "tag": self.tags,
-            "r18": self.r18,
-            "proxy": self.reverse_proxy_url,
-            "num": self.num,
-            "size": self.size,
-            "excludeAI": self.excludeAI,
-        }
-        headers = {"Content-Type": "application/json"}
-
-        async with AsyncClient(proxy=self.proxy) as client:
-            res = await client.post(
-                self.api_url, json=data, headers=headers, timeout=60
-            )
-        data = res.json()
-        setu_api_data_instance = SetuApiData(**data)
-        if len(setu_api_data_instance.data) == 0:
-            raise SetuNotFindError()
-        logger.debug(f"API Responsed {len(setu_api_data_instance.data)} image")
-        for i in setu_api_data_instance.data:
-            self.setu_instance_list.append(Setu(data=i))
+        self.setu_instance_list += await QUERY_CACHE.fetch(
+            self.key, self.tags, self.r18, self.num, self.excludeAI
+        )
 
     async def prep_handler(self, setu: Setu):
         setu.img = await download_pic(
@@ -68,17 +108,66 @@ class SetuHandler:
             proxy=self.proxy,
             file_mode=True,
             file_name=f"{setu.pid}.{setu.ext}",
+            to_memory=DOWNLOAD_TO_MEMORY,
+            user_id=self.user_id,
         )
         await self.handler(setu)
 
+    async def drop_duplicates(self, prefetched: List[Setu]) -> List[Setu]:
+        """
+        按缩略图的感知哈希去掉本群近期发过的图片，被去掉的图片用新的 API 结果补足。
+        返回留下的预取图片，其余图片留在 ``setu_instance_list`` 中等待下载。
+        """
+        prefetched_ids = {id(i) for i in prefetched}
+        wanted = len(prefetched) + len(self.setu_instance_list)
+        kept: List[Setu] = []
+        new = prefetched + self.setu_instance_list
+        for retry in range(self.DEDUPE_RETRIES + 1):
+            hashes = [i.dhash for i in kept] + list(
+                await gather(*(fetch_dhash(i, self.proxy, self.user_id) for i in new))
+            )
+            kept = drop_near_duplicates(self.group_key, kept + new, hashes)
+            missing = wanted - len(kept)
+            if missing <= 0 or retry == self.DEDUPE_RETRIES:
+                break
+            try:
+                new = await QUERY_CACHE.fetch(
+                    self.key, self.tags, self.r18, missing, self.excludeAI
+                )
+            except SetuNotFindError:
+                break
+        self.dropped = max(0, wanted - len(kept))
+        self.setu_instance_list = [i for i in kept if id(i) not in prefetched_ids]
+        kept_ids = {id(i) for i in kept}
+        if IMAGE_CACHE is None and SETU_PATH is None:
+            # 未启用缓存时预取的图片只是临时文件，被去掉的直接删除
+            for setu in prefetched:
+                if id(setu) not in kept_ids and setu.img is not None:
+                    discard_image(Path(setu.img))
+        return [i for i in kept if id(i) in prefetched_ids]
+
     async def process_request(self):
         if REPO_BASE_URL != "" and not (self.key or self.tags or self.r18):
-            image_path = await fetch_local_pic()
-            setu = Setu.local_setu(image_path)
+            image = await REPO_SOURCE.fetch(self.user_id)
+            setu = Setu.local_setu(image)
             await self.handler(setu)
             return
-        await self.refresh_api_info()
-        task_list = []
+        # 不带关键词和标签的请求优先使用预先下载好的图片
+        prefetched: List[Setu] = []
+        if not (self.key or self.tags):
+            prefetched = PREFETCH_POOL.take(self.r18, self.excludeAI, self.num)
+            if prefetched:
+                logger.debug(f"Serving {len(prefetched)} image from prefetch pool")
+        self.num -= len(prefetched)
+        if self.num > 0:
+            try:
+                await self.refresh_api_info()
+            except SetuNotFindError:
+                if not prefetched:
+                    raise
+        if self.group_key and DEDUPE_INDEX.enabled:
+            prefetched = await self.drop_duplicates(prefetched)
+        task_list = [self.handler(i) for i in prefetched]
         for i in self.setu_instance_list:
             task_list.append(self.prep_handler(i))
         await gather(*task_list)
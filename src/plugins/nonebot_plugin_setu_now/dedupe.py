@@ -0,0 +1,169 @@
+import time
+from io import BytesIO
+from typing import Dict, List, Deque, Tuple, Optional
+from collections import deque
+
+from PIL import Image
+from nonebot.log import logger
+
+from .utils import download_pic
+from .config import DEDUPE_WINDOW, DEDUPE_DISTANCE
+from .models import Setu
+
+HASH_SIZE = "mini"  # 用于计算感知哈希的缩略图尺寸，预取和 API 结果都用它
+
+
+def dhash(data: bytes, size: int = 8) -> int:
+    """64 位差值哈希：缩小为 (size + 1) x size 的灰度图后比较相邻像素"""
+    with Image.open(BytesIO(data)) as img:
+        img.draft("L", (size + 1, size))
+        small = img.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """按汉明距离组织的 BK 树，节点记录哈希最近一次出现的时间"""
+
+    def __init__(self) -> None:
+        # 节点为 [hash, last_seen, {distance: child}]
+        self._root: Optional[list] = None
+
+    def add(self, value: int, seen_at: float) -> None:
+        if self._root is None:
+            self._root = [value, seen_at, {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1] = max(node[1], seen_at)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, seen_at, {}]
+                return
+            node = child
+
+    def contains(self, value: int, radius: int, since: float) -> bool:
+        """是否存在 ``since`` 之后出现过、距离不超过 ``radius`` 的哈希"""
+        if self._root is None:
+            return False
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius and node[1] >= since:
+                return True
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return False
+
+
+class _GroupIndex:
+    __slots__ = ("tree", "entries", "expired")
+
+    def __init__(self) -> None:
+        self.tree = BKTree()
+        self.entries: Deque[Tuple[float, int]] = deque()
+        self.expired = 0
+
+
+class DedupeIndex:
+    """
+    按群记录最近 ``window`` 秒内发送过的图片的感知哈希。
+
+    汉明距离不超过 ``distance`` 即视为同一张图。过期的哈希在查询时被忽略，
+    过期数量超过仍有效的数量时重建 BK 树。
+    """
+
+    def __init__(self, window: int, distance: int) -> None:
+        self.window = window
+        self.distance = distance
+        self._groups: Dict[str, _GroupIndex] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def _prune(self, group_key: str, index: _GroupIndex, now: float) -> None:
+        cutoff = now - self.window
+        while index.entries and index.entries[0][0] < cutoff:
+            index.entries.popleft()
+            index.expired += 1
+        if not index.entries:
+            del self._groups[group_key]
+        elif index.expired > len(index.entries):
+            index.tree = BKTree()
+            for seen_at, value in index.entries:
+                index.tree.add(value, seen_at)
+            index.expired = 0
+
+    def is_duplicate(self, group_key: str, value: int) -> bool:
+        index = self._groups.get(group_key)
+        if index is None:
+            return False
+        now = time.time()
+        self._prune(group_key, index, now)
+        return index.tree.contains(value, self.distance, now - self.window)
+
+    def add(self, group_key: str, value: int) -> None:
+        if not self.enabled:
+            return
+        now = time.time()
+        index = self._groups.get(group_key)
+        if index is None:
+            index = self._groups[group_key] = _GroupIndex()
+        index.entries.append((now, value))
+        index.tree.add(value, now)
+
+
+async def fetch_dhash(setu: Setu, proxy: Optional[str], user_id: str = "") -> Optional[int]:
+    """下载缩略图计算哈希，失败时返回 None；已经算过哈希（如预取的图片）时直接返回"""
+    if setu.dhash is not None:
+        return setu.dhash
+    url = setu.urls.get(HASH_SIZE)
+    if url is None:
+        return None
+    data = await download_pic(
+        url=url, proxy=proxy, to_memory=True, user_id=user_id, cache=False
+    )
+    if not isinstance(data, bytes):
+        return None
+    try:
+        return dhash(data)
+    except Exception as e:
+        logger.warning(f"Hash image {setu.pid} failed: {e}")
+        return None
+
+
+def drop_near_duplicates(
+    group_key: str, setus: List[Setu], hashes: List[Optional[int]]
+) -> List[Setu]:
+    """去掉与本群近期发送过的图片或同批中更早的图片相近的图片"""
+    result: List[Setu] = []
+    accepted: List[int] = []
+    for setu, value in zip(setus, hashes):
+        setu.dhash = value
+        if value is not None:
+            if DEDUPE_INDEX.is_duplicate(group_key, value) or any(
+                hamming(value, other) <= DEDUPE_INDEX.distance for other in accepted
+            ):
+                logger.debug(f"Dropped near-duplicate image {setu.pid}")
+                continue
+            accepted.append(value)
+        result.append(setu)
+    return result
+
+
+DEDUPE_INDEX = DedupeIndex(DEDUPE_WINDOW, DEDUPE_DISTANCE)
@@ -0,0 +1,208 @@
+"""
+``img_utils`` 中图片特效的 NumPy 实现。
+
+随机数的取用顺序与 PIL 版本一致，相同的随机种子下输出等价；
+随机画线时所有线段的像素一次性写入。
+
+``BATCH_FUNCS`` 中的批量版本把尺寸相同的帧叠成一个数组一次处理，
+随机数仍按帧的顺序取用，结果与逐张调用相同。
+"""
+import math
+from random import choice, randint
+from typing import Dict, List, Tuple, Callable
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+
+Frames = List[Image.Image]
+
+
+def _same_size_groups(frames: Frames) -> Dict[Tuple[str, Tuple[int, int]], List[int]]:
+    """按 (mode, size) 分组，返回各组帧的下标"""
+    groups: Dict[Tuple[str, Tuple[int, int]], List[int]] = {}
+    for index, frame in enumerate(frames):
+        groups.setdefault((frame.mode, frame.size), []).append(index)
+    return groups
+
+
+def _frame_background(img: Image.Image) -> Image.Image:
+    BLUR_HEIGHT_QUALITY = 128
+    FRAME_RATIO = 1.5
+    resize_resoluation = (
+        int(img.width * (BLUR_HEIGHT_QUALITY / img.height)),
+        BLUR_HEIGHT_QUALITY,
+    )
+    # 模糊只作用在很小的图上，交给 PIL 完成
+    background = img.resize(resize_resoluation, reducing_gap=2.0)
+    background = background.filter(ImageFilter.GaussianBlur(6))
+    return background.resize(
+        (int(img.width * FRAME_RATIO), int(img.height * FRAME_RATIO)),
+        Image.Resampling.BILINEAR,
+    )
+
+
+def draw_frame(img: Image.Image) -> Image.Image:
+    """画边框"""
+    background = _frame_background(img)
+    canvas = np.array(background)
+    left = int((background.width - img.width) / 2)
+    top = int((background.height - img.height) / 2)
+    canvas[top : top + img.height, left : left + img.width] = np.asarray(img)
+    return Image.fromarray(canvas, background.mode)
+
+
+def random_rotate(img: Image.Image) -> Image.Image:
+    """随机旋转角度，与 ``Image.rotate(expand=True)`` 相同的最近邻采样"""
+    angle = float(randint(0, 360)) % 360.0
+    src = np.asarray(img)
+    if angle == 0:
+        return img.copy()
+    if angle == 180:
+        return Image.fromarray(np.ascontiguousarray(src[::-1, ::-1]), img.mode)
+    if angle == 90:
+        return Image.fromarray(np.ascontiguousarray(np.rot90(src, 1)), img.mode)
+    if angle == 270:
+        return Image.fromarray(np.ascontiguousarray(np.rot90(src, 3)), img.mode)
+
+    w, h = img.size
+    rad = -math.radians(angle)
+    a, b = round(math.cos(rad), 15), round(math.sin(rad), 15)
+    d, e = round(-math.sin(rad), 15), round(math.cos(rad), 15)
+    cx, cy = w / 2.0, h / 2.0
+    c = a * -cx + b * -cy + cx
+    f = d * -cx + e * -cy + cy
+    xx, yy = [], []
+    for x, y in ((0, 0), (w, 0), (w, h), (0, h)):
+        xx.append(a * x + b * y + c)
+        yy.append(d * x + e * y + f)
+    nw = math.ceil(max(xx)) - math.floor(min(xx))
+    nh = math.ceil(max(yy)) - math.floor(min(yy))
+    ox, oy = -(nw - w) / 2.0, -(nh - h) / 2.0
+    c, f = a * ox + b * oy + c, d * ox + e * oy + f
+
+    # 对输出的每个像素中心反求源图坐标
+    xs = np.arange(nw, dtype=np.float64) + 0.5
+    ys = np.arange(nh, dtype=np.float64)[:, None] + 0.5
+    src_x = np.floor(a * xs + b * ys + c).astype(np.intp)
+    src_y = np.floor(d * xs + e * ys + f).astype(np.intp)
+    valid = (src_x >= 0) & (src_x < w) & (src_y >= 0) & (src_y < h)
+    out = np.zeros((nh, nw) + src.shape[2:], dtype=src.dtype)
+    out[valid] = src[src_y[valid], src_x[valid]]
+    return Image.fromarray(out, img.mode)
+
+
+def random_flip(img: Image.Image) -> Image.Image:
+    """随机翻转"""
+    arr = np.asarray(img)
+    flipped = choice([arr[::-1], arr[:, ::-1]])
+    return Image.fromarray(np.ascontiguousarray(flipped), img.mode)
+
+
+def _line_pixels(size: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """随机生成若干条线段，返回落在图内的像素坐标 (ys, xs)"""
+    x, y = size
+    line_width = max(1, round(min(x, y) * 0.001))
+    offsets = np.arange(line_width) - line_width // 2
+    xs_list: List[np.ndarray] = []
+    ys_list: List[np.ndarray] = []
+    for _ in range(randint(0, 10)):
+        if randint(0, 1):
+            # 横
+            x0, y0, x1, y1 = 0, randint(0, y), y, randint(0, y)
+        else:
+            # 竖
+            x0, y0, x1, y1 = randint(0, x), 0, randint(0, x), y
+        n = max(abs(x1 - x0), abs(y1 - y0)) + 1
+        line_x = np.rint(np.linspace(x0, x1, n)).astype(np.intp)
+        line_y = np.rint(np.linspace(y0, y1, n)).astype(np.intp)
+        # 线宽沿与线段主方向垂直的方向展开
+        if abs(x1 - x0) >= abs(y1 - y0):
+            line_y = (line_y[None, :] + offsets[:, None]).ravel()
+            line_x = np.tile(line_x, line_width)
+        else:
+            line_x = (line_x[None, :] + offsets[:, None]).ravel()
+            line_y = np.tile(line_y, line_width)
+        xs_list.append(line_x)
+        ys_list.append(line_y)
+    if not xs_list:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty
+    xs = np.concatenate(xs_list)
+    ys = np.concatenate(ys_list)
+    inside = (xs >= 0) & (xs < x) & (ys >= 0) & (ys < y)
+    return ys[inside], xs[inside]
+
+
+def random_lines(img: Image.Image) -> Image.Image:
+    """随机画黑线"""
+    arr = np.array(img)
+    ys, xs = _line_pixels(img.size)
+    # 与 ImageDraw 的 fill=0 一致，所有通道都置为 0
+    arr[ys, xs] = 0
+    return Image.fromarray(arr, img.mode)
+
+
+def batch_draw_frame(frames: Frames) -> Frames:
+    """批量画边框：模糊背景逐张生成，同尺寸的帧一次贴到各自的背景中央"""
+    backgrounds = [_frame_background(frame) for frame in frames]
+    result: Frames = list(frames)
+    for (mode, (width, height)), indexes in _same_size_groups(frames).items():
+        canvas = np.stack([np.asarray(backgrounds[i]) for i in indexes])
+        left = int((canvas.shape[2] - width) / 2)
+        top = int((canvas.shape[1] - height) / 2)
+        canvas[:, top : top + height, left : left + width] = np.stack(
+            [np.asarray(frames[i]) for i in indexes]
+        )
+        for j, i in enumerate(indexes):
+            result[i] = Image.fromarray(canvas[j], mode)
+    return result
+
+
+def batch_random_flip(frames: Frames) -> Frames:
+    """批量随机翻转"""
+    # 与 random_flip 的 choice 取用同样的随机数，True 为上下翻转
+    vertical = [choice([True, False]) for _ in frames]
+    result: Frames = list(frames)
+    for (mode, _), indexes in _same_size_groups(frames).items():
+        stack = np.stack([np.asarray(frames[i]) for i in indexes])
+        flags = np.array([vertical[i] for i in indexes])
+        # 上下翻转与左右翻转后的形状相同，可以写入同一个数组
+        out = np.empty_like(stack)
+        out[flags] = stack[flags, ::-1]
+        out[~flags] = stack[~flags, :, ::-1]
+        for j, i in enumerate(indexes):
+            result[i] = Image.fromarray(out[j], mode)
+    return result
+
+
+def batch_random_lines(frames: Frames) -> Frames:
+    """批量随机画黑线，同尺寸帧的所有线段像素一次写入"""
+    pixels = [_line_pixels(frame.size) for frame in frames]
+    result: Frames = list(frames)
+    for (mode, _), indexes in _same_size_groups(frames).items():
+        stack = np.stack([np.asarray(frames[i]) for i in indexes])
+        ns = np.concatenate(
+            [np.full(len(pixels[i][0]), j, dtype=np.intp) for j, i in enumerate(indexes)]
+        )
+        ys = np.concatenate([pixels[i][0] for i in indexes])
+        xs = np.concatenate([pixels[i][1] for i in indexes])
+        stack[ns, ys, xs] = 0
+        for j, i in enumerate(indexes):
+            result[i] = Image.fromarray(stack[j], mode)
+    return result
+
+
+EFFECT_FUNCS: Dict[str, Callable[[Image.Image], Image.Image]] = {
+    "draw_frame": draw_frame,
+    "random_rotate": random_rotate,
+    "random_flip": random_flip,
+    "random_lines": random_lines,
+}
+
+# 旋转角度各不相同，输出尺寸也不同，没有批量版本
+BATCH_FUNCS: Dict[str, Callable[[Frames], Frames]] = {
+    "draw_frame": batch_draw_frame,
+    "random_flip": batch_random_flip,
+    "random_lines": batch_random_lines,
+}
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from typing import Set, Dict, List, Callable, Optional
+from pathlib import Path
+from collections import OrderedDict
+
+import nonebot_plugin_localstore as store
+from nonebot.log import logger
+
+from .config import SETU_PATH, IMAGE_CACHE_MAX_BYTES
+
+
+class FileCache:
+    """
+    目录中文件的 LRU 缓存。
+
+    内存索引记录每个文件的大小和最近访问时间，并保存到目录下的 ``index.json``，
+    重启后与目录内容对账即可恢复。总大小超过 ``max_bytes`` 时删除最久未访问的文件。
+    在事件循环中使用时，定期保存索引和删除文件都放到线程中进行。
+    """
+
+    INDEX_FILE = "index.json"
+    SAVE_EVERY = 100  # 索引每变化多少次写一次盘
+
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # name -> [size, last_access]，按访问时间从旧到新排列
+        self._index: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._total = 0
+        self._changes = 0
+        self._io_tasks: Set[asyncio.Task] = set()
+        self._index_lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+
+    @property
+    def index_path(self) -> Path:
+        return self.directory / self.INDEX_FILE
+
+    def _load_index(self) -> None:
+        saved: Dict[str, List[float]] = {}
+        if self.index_path.exists():
+            try:
+                saved = json.loads(self.index_path.read_text())
+            except ValueError:
+                logger.warning("Broken image cache index, rebuilding")
+        entries: Dict[str, List[float]] = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                # 跳过子目录、索引文件和下载中的临时文件
+                if (
+                    not entry.is_file()
+                    or entry.name == self.INDEX_FILE
+                    or entry.name.endswith((".tmp", ".part"))
+                ):
+                    continue
+                stat = entry.stat()
+                last_access = saved[entry.name][1] if entry.name in saved else stat.st_mtime
+                entries[entry.name] = [stat.st_size, last_access]
+        for name, value in sorted(entries.items(), key=lambda item: item[1][1]):
+            self._index[name] = value
+            self._total += int(value[0])
+        logger.info(f"File cache {self.directory}: {len(self._index)} files, {self._total} bytes")
+        self._evict()
+
+    def _run_io(self, func: Callable, *args) -> None:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # 启动时加载索引不在事件循环中，直接执行
+            func(*args)
+            return
+        task = asyncio.create_task(asyncio.to_thread(func, *args))
+        self._io_tasks.add(task)
+        task.add_done_callback(self._io_tasks.discard)
+
+    def _write_index(self, content: str) -> None:
+        with self._index_lock:
+            tmp_path = self.index_path.with_suffix(".tmp")
+            tmp_path.write_text(content)
+            os.replace(tmp_path, self.index_path)
+
+    def save_index(self) -> None:
+        """同步保存索引，用于关闭时"""
+        self._write_index(json.dumps(self._index, separators=(",", ":")))
+        self._changes = 0
+
+    def _changed(self) -> None:
+        self._changes += 1
+        if self._changes >= self.SAVE_EVERY:
+            # 在事件循环中生成快照，写盘交给线程
+            self._run_io(self._write_index, json.dumps(self._index, separators=(",", ":")))
+            self._changes = 0
+
+    def path(self, name: str) -> Path:
+        return self.directory / name
+
+    def get(self, name: str) -> Optional[Path]:
+        value = self._index.get(name)
+        if value is None:
+            return None
+        path = self.path(name)
+        if not path.exists():
+            self._drop(name)
+            return None
+        value[1] = time.time()
+        self._index.move_to_end(name)
+        self._changed()
+        return path
+
+    def add(self, name: str) -> Path:
+        """登记已经写入 ``path(name)`` 的文件"""
+        path = self.path(name)
+        size = path.stat().st_size
+        if name in self._index:
+            self._total -= int(self._index[name][0])
+        self._index[name] = [size, time.time()]
+        self._index.move_to_end(name)
+        self._total += size
+        self._changed()
+        self._evict()
+        return path
+
+    def _drop(self, name: str) -> None:
+        value = self._index.pop(name, None)
+        if value is not None:
+            self._total -= int(value[0])
+            self._changed()
+
+    def discard(self, name: str) -> None:
+        self._drop(name)
+        self.path(name).unlink(missing_ok=True)
+
+    def _unlink(self, names: List[str]) -> None:
+        for name in names:
+            # 在线程中执行前同名图片可能已经重新下载并登记，不能删掉新文件
+            if name not in self._index:
+                self.path(name).unlink(missing_ok=True)
+
+    def _evict(self) -> None:
+        # 至少保留最新的一个文件，刚下载的图片不会在发送前被删除
+        evicted: List[str] = []
+        while self._total > self.max_bytes and len(self._index) > 1:
+            name, (size, _) = self._index.popitem(last=False)
+            self._total -= int(size)
+            evicted.append(name)
+            logger.debug(f"File cache evicted {name}")
+            self._changed()
+        if evicted:
+            self._run_io(self._unlink, evicted)
+
+
+IMAGE_CACHE: Optional[FileCache] = (
+    FileCache(
+        Path(SETU_PATH) if SETU_PATH else store.get_cache_dir("nonebot_plugin_setu_now"),
+        IMAGE_CACHE_MAX_BYTES,
+    )
+    if IMAGE_CACHE_MAX_BYTES > 0
+    else None
+)
+
+
+def discard_image(path: Path) -> None:
+    """删除图片文件，同时从缓存索引中移除"""
+    if IMAGE_CACHE is not None and path.parent == IMAGE_CACHE.directory:
+        IMAGE_CACHE.discard(path.name)
+    else:
+        path.unlink(missing_ok=True)
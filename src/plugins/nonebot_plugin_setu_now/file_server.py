@@ -0,0 +1,172 @@
+import os
+import re
+import hmac
+import time
+import asyncio
+import hashlib
+from typing import Union, Optional
+from pathlib import Path
+from urllib.parse import urlencode
+
+import nonebot_plugin_localstore as store
+from nonebot import get_app, get_driver
+from nonebot.log import logger
+from nonebot.adapters.onebot.v11 import MessageSegment
+
+from .utils import _write_image
+from .config import SERVE_TTL, FILE_SEND_MODE, SERVE_BASE_URL
+
+MEDIA_TYPES = {"jpg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+
+
+def _guess_ext(data: bytes) -> str:
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    return "jpg"
+
+
+def _write_file(path: Path, data: bytes) -> None:
+    try:
+        # 内容相同的文件已经存在，刷新修改时间以推迟清理
+        os.utime(path)
+        return
+    except FileNotFoundError:
+        # 文件不存在，或者刚好被清理任务删除，重新写入
+        pass
+    # 同一张图同时发到多个群时各自写入唯一的临时文件
+    _write_image(path, data)
+
+
+class FileServer:
+    """
+    以文件而不是 base64 的方式发送图片。
+
+    ``mode`` 为 ``url`` 时，图片按内容哈希写入 ``directory``，由 FastAPI 驱动器上的路由提供，
+    消息中只包含一个带签名、``ttl`` 秒后失效的地址；为 ``file`` 时直接发送本地文件路径，
+    要求 OneBot 实现与 bot 在同一台机器上。超过 ``ttl`` 的文件由后台任务定期清理。
+    ``mode`` 为 ``base64`` 时保持原来的行为。
+    """
+
+    ROUTE = "/setu/image"
+    NAME_PATTERN = re.compile(r"[0-9a-f]{64}\.(jpg|webp|png)")
+
+    def __init__(self, mode: str, directory: Path, base_url: str, ttl: int) -> None:
+        self.mode = mode
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+        self.ttl = ttl
+        self._secret = os.urandom(32)
+        self._sweeper: Optional[asyncio.Task] = None
+        if self.mode not in ("base64", "url", "file"):
+            logger.warning(f"Unknown setu_file_send_mode {self.mode}, using base64")
+            self.mode = "base64"
+        if self.mode == "url" and not self._setup_route():
+            self.mode = "base64"
+        if self.enabled:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "base64"
+
+    def _setup_route(self) -> bool:
+        try:
+            from fastapi import HTTPException
+            from fastapi.responses import FileResponse
+
+            app = get_app()
+        except Exception:
+            logger.warning("setu_file_send_mode=url requires DRIVER=~fastapi, using base64")
+            return False
+        if not self.base_url:
+            config = get_driver().config
+            host = str(config.host)
+            if host in ("0.0.0.0", "::"):
+                host = "127.0.0.1"
+            self.base_url = f"http://{host}:{config.port}"
+
+        @app.get(f"{self.ROUTE}/{{name}}")
+        async def _(name: str, expires: int, sig: str):
+            if (
+                not self.NAME_PATTERN.fullmatch(name)
+                or expires < time.time()
+                or not hmac.compare_digest(sig, self.sign(name, expires))
+            ):
+                raise HTTPException(status_code=404)
+            path = self.directory / name
+            if not path.is_file():
+                raise HTTPException(status_code=404)
+            return FileResponse(path, media_type=MEDIA_TYPES[name.rsplit(".", 1)[1]])
+
+        return True
+
+    def sign(self, name: str, expires: int) -> str:
+        message = f"{name}:{expires}".encode()
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+    def url_for(self, name: str) -> str:
+        expires = int(time.time()) + self.ttl
+        query = urlencode({"expires": expires, "sig": self.sign(name, expires)})
+        return f"{self.base_url}{self.ROUTE}/{name}?{query}"
+
+    async def publish(self, data: bytes) -> Path:
+        """按内容哈希写入图片，哈希和写盘都在线程中进行"""
+
+        def write() -> Path:
+            name = f"{hashlib.sha256(data).hexdigest()}.{_guess_ext(data)}"
+            path = self.directory / name
+            _write_file(path, data)
+            return path
+
+        return await asyncio.to_thread(write)
+
+    async def segment(self, image: Union[Path, bytes]) -> MessageSegment:
+        if not self.enabled or isinstance(image, Path):
+            return MessageSegment.image(image)
+        path = await self.publish(image)
+        if self.mode == "file":
+            return MessageSegment.image(path)
+        return MessageSegment.image(self.url_for(path.name))
+
+    def _sweep(self) -> int:
+        cutoff = time.time() - self.ttl
+        removed = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        return removed
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(max(30, self.ttl // 2))
+            try:
+                if removed := await asyncio.to_thread(self._sweep):
+                    logger.debug(f"File server removed {removed} expired images")
+            except OSError as e:
+                logger.warning(f"Sweep served images failed: {e}")
+
+    def start(self) -> None:
+        if self.enabled and self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def aclose(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+
+FILE_SERVER = FileServer(
+    FILE_SEND_MODE,
+    Path(store.get_cache_dir("nonebot_plugin_setu_now")) / "serve",
+    SERVE_BASE_URL,
+    SERVE_TTL,
+)
@@ -0,0 +1,45 @@
+from typing import Dict, Optional
+from importlib.util import find_spec
+
+from httpx import Limits, AsyncClient
+from nonebot.log import logger
+
+from .config import HTTP2, KEEPALIVE_EXPIRY, MAX_CONNECTIONS, MAX_KEEPALIVE_CONNECTIONS
+
+
+class ClientManager:
+    """
+    插件共用的长连接 ``AsyncClient``，按代理设置区分。
+    连接池在多次请求之间复用，同一主机的图片下载不必每次重新握手。
+    """
+
+    def __init__(self) -> None:
+        self._clients: Dict[Optional[str], AsyncClient] = {}
+        self.http2 = HTTP2
+        if self.http2 and find_spec("h2") is None:
+            logger.warning("HTTP/2 requires the h2 package, falling back to HTTP/1.1")
+            self.http2 = False
+
+    def get(self, proxy: Optional[str] = None) -> AsyncClient:
+        client = self._clients.get(proxy)
+        if client is None or client.is_closed:
+            client = AsyncClient(
+                proxy=proxy,
+                http2=self.http2,
+                timeout=5,
+                limits=Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=KEEPALIVE_EXPIRY,
+                ),
+            )
+            self._clients[proxy] = client
+        return client
+
+    async def aclose(self) -> None:
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+
+CLIENT_MANAGER = ClientManager()
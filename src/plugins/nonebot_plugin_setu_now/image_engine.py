@@ -0,0 +1,115 @@
+import os
+import random
+import asyncio
+from typing import Union, Callable, Optional
+from pathlib import Path
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_context
+from collections import OrderedDict
+
+from nonebot.log import logger
+
+from .config import IMAGE_WORKERS
+from .img_utils import DecodedImage, QualityHints, do_nothing, render_effect
+
+
+def _init_worker() -> None:
+    # fork 出的子进程继承了同一个随机数状态，重新播种以免各进程的特效完全相同
+    random.seed()
+
+
+class ImageEngine:
+    """
+    在事件循环之外执行图片特效和 JPEG 编码。
+
+    ``workers`` 为 0 时使用线程池；大于 0 时使用对应数量的子进程，
+    子进程以 fork 方式启动以继承已经加载的插件模块，需要在其他线程启动前调用 ``start``。
+    已经解码出基准帧后，子进程只接收基准帧或原图中的一个，不重复传输两者。
+    排队中的任务不超过 ``workers`` 的 ``QUEUE_FACTOR`` 倍，超出时调用方等待。
+    按大小编码时按 pid 分别记住原图和基准帧选中的质量，下次从该质量开始查找。
+    """
+
+    QUEUE_FACTOR = 4
+    QUALITY_CACHE_SIZE = 4096
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self._executor: Optional[Executor] = None
+        size = workers or min(4, os.cpu_count() or 1)
+        self._semaphore = asyncio.Semaphore(size * self.QUEUE_FACTOR)
+        # pid -> 按大小编码时原图和基准帧上次选中的质量
+        self._qualities: "OrderedDict[int, QualityHints]" = OrderedDict()
+
+    def start(self) -> None:
+        """
+        创建进程池并立即 fork 出全部子进程。
+
+        fork 只复制调用它的线程，其他线程持有的锁在子进程中永远不会释放，
+        所以必须在插件加载时、事件循环和其他线程启动之前调用。
+        """
+        if self.workers <= 0 or self._executor is not None:
+            return
+        executor = ProcessPoolExecutor(
+            self.workers,
+            mp_context=get_context("fork"),
+            initializer=_init_worker,
+        )
+        # fork 方式下第一次提交任务时一次创建全部子进程
+        executor.submit(os.getpid)
+        self._executor = executor
+        logger.info(f"Image engine started with {self.workers} processes")
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.workers > 0:
+                raise RuntimeError("Image engine process pool is not started")
+            self._executor = ThreadPoolExecutor(
+                min(4, os.cpu_count() or 1), thread_name_prefix="setu-image"
+            )
+        return self._executor
+
+    async def render(
+        self, image: DecodedImage, effect: Callable
+    ) -> Union[Path, bytes]:
+        """对 ``image`` 应用特效并编码，返回可以直接用于 ``MessageSegment.image`` 的内容"""
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            executor = self._get_executor()
+            if image.qualities == (None, None) and image.key in self._qualities:
+                image.source_quality, image.frame_quality = self._qualities[image.key]
+            if self.workers <= 0:
+                # 线程池与事件循环共享内存，基准帧直接缓存在 image 上
+                result = await loop.run_in_executor(
+                    executor, image.render, effect.__name__
+                )
+            else:
+                # 有基准帧时特效只需要基准帧；不加特效时只需要原图
+                if effect.__name__ == do_nothing.__name__ or image.payload is None:
+                    source, payload = image.source, None
+                else:
+                    source, payload = None, image.payload
+                result, payload, qualities = await loop.run_in_executor(
+                    executor,
+                    render_effect,
+                    source,
+                    effect.__name__,
+                    payload,
+                    image.qualities,
+                )
+                image.source_quality, image.frame_quality = qualities
+                if payload is not None:
+                    image.payload = payload
+            if image.key is not None and image.qualities != (None, None):
+                self._qualities[image.key] = image.qualities
+                self._qualities.move_to_end(image.key)
+                if len(self._qualities) > self.QUALITY_CACHE_SIZE:
+                    self._qualities.popitem(last=False)
+            return result
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+IMAGE_ENGINE = ImageEngine(IMAGE_WORKERS)
@@ -1,45 +1,53 @@
 from io import BytesIO
 from random import choice, randint
-from typing import Union
+from typing import Dict, List, Tuple, Union, Callable, Optional
 from pathlib import Path
 
 from PIL import Image, ImageFilter
 from nonebot.log import logger
-from nonebot.adapters.onebot.v11 import MessageSegment
 
-from .config import SEND_AS_BYTES
+from .config import ALLOW_WEBP, NUMPY_EFFECTS, SEND_AS_BYTES, MAX_IMAGE_BYTES
 from .perf_timer import PerfTimer
 
+try:
+    from . import effects_np
+except ImportError:  # 未安装 numpy 时只使用 PIL 实现
+    effects_np = None
+
 
 def image_param_converter(source: Union[Path, Image.Image, bytes]) -> Image.Image:
     FORCE_RESIZE = True
     IMAGE_RESIZE_RES = 1080  # 限制被处理图片最大为1080P
 
+    def target_size(img: Image.Image) -> Optional[Tuple[int, int]]:
+        if not FORCE_RESIZE or min(*img.size) <= IMAGE_RESIZE_RES:
+            return None
+        if img.width >= img.height:
+            return (int(IMAGE_RESIZE_RES / img.height * img.width), IMAGE_RESIZE_RES)
+        return (IMAGE_RESIZE_RES, int(IMAGE_RESIZE_RES / img.width * img.height))
+
     def resize_converter(img: Image.Image):
-        if not FORCE_RESIZE:
-            return img
-        image_landscape = img.width >= img.height
-        if min(*img.size) <= IMAGE_RESIZE_RES:
+        resize_res = target_size(img)
+        if resize_res is None:
             return img
-        if image_landscape:
-            resize_res = (
-                int(IMAGE_RESIZE_RES / img.height * img.width),
-                IMAGE_RESIZE_RES,
-            )
-        else:
-            resize_res = (
-                IMAGE_RESIZE_RES,
-                int(IMAGE_RESIZE_RES / img.width * img.height),
-            )
         logger.debug(f"Effect force resize: {img.size} -> {resize_res}")
-        return img.resize(resize_res)
+        # reducing_gap 先按整数倍快速缩小，再做精确的重采样
+        return img.resize(resize_res, reducing_gap=3.0)
+
+    def open_reduced(fp) -> Image.Image:
+        img = Image.open(fp)
+        resize_res = target_size(img)
+        if resize_res is not None and img.format == "JPEG":
+            # JPEG 可以在解码时按 1/2、1/4、1/8 缩小，只解码需要的像素
+            img.draft(img.mode, resize_res)
+        return resize_converter(img)
 
     if isinstance(source, Path):
-        return resize_converter(Image.open(source))
+        return open_reduced(source)
     if isinstance(source, Image.Image):
         return resize_converter(source)
     if isinstance(source, bytes):
-        return resize_converter(Image.open(BytesIO(source)))
+        return open_reduced(BytesIO(source))
     raise ValueError(f"Unsopported image type: {type(source)}")
 
 
@@ -52,11 +60,12 @@ def draw_frame(img: Union[Path, Image.Image, bytes]) -> Image.Image:
         int(img.width * (BLUR_HEIGHT_QUALITY / img.height)),
         BLUR_HEIGHT_QUALITY,
     )
-    background = img
-    background = background.resize(resize_resoluation)
+    # 背景取自已经缩小过的图片，模糊后再放大，放大时用双线性插值即可
+    background = img.resize(resize_resoluation, reducing_gap=2.0)
     background = background.filter(ImageFilter.GaussianBlur(6))
     background = background.resize(
-        (int(img.width * FRAME_RATIO), int(img.height * FRAME_RATIO))
+        (int(img.width * FRAME_RATIO), int(img.height * FRAME_RATIO)),
+        Image.Resampling.BILINEAR,
     )
     background.paste(
         img,
@@ -112,17 +121,18 @@ def random_lines(img: Union[Path, Image.Image, bytes]) -> Image.Image:
     return img
 
 
-def do_nothing(img: Path) -> Path:
+def do_nothing(img: Union[Path, bytes]) -> Union[Path, bytes]:
     return img
 
 
-def image_segment_convert(img: Union[Path, Image.Image, bytes]) -> MessageSegment:
+def encode_image(img: Union[Path, Image.Image, bytes]) -> Union[Path, bytes]:
+    """将处理后的图片编码为 JPEG；不以 bytes 发送时未处理的图片直接返回路径"""
     if isinstance(img, Path):
         # 将图片读取
         if SEND_AS_BYTES:
             img = Image.open(img)
         else:
-            return MessageSegment.image(img)
+            return img
     elif isinstance(img, bytes):
         img = Image.open(BytesIO(img))
     elif isinstance(img, Image.Image):
@@ -139,7 +149,193 @@ def image_segment_convert(img: Union[Path, Image.Image, bytes]) -> MessageSegmen
         quality="keep" if img.format in ("JPEG", "JPG") else 95,
     )
     save_timer.stop()
-    return MessageSegment.image(image_bytesio)  # type: ignore
+    return image_bytesio.getvalue()
+
+
+QUALITY_LEVELS = list(range(30, 96, 5))  # 按大小编码时可选的 JPEG 质量
+
+
+def encode_to_size(
+    img: Image.Image, max_bytes: int, hint: Optional[int] = None
+) -> Tuple[bytes, int, bool]:
+    """
+    以不超过 ``max_bytes`` 的最高质量编码为渐进式 JPEG，在 ``QUALITY_LEVELS`` 中二分查找。
+    ``hint`` 为上次选中的质量，先试它和高一档的质量，通常两次编码即可确定。
+    返回 (数据, 质量, 是否满足大小限制)；最低质量仍然超出时返回最低质量的结果。
+    """
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    save_timer = PerfTimer.start(f"Save bytes to size {img.width} x {img.height}")
+    results: Dict[int, bytes] = {}
+
+    def encode(index: int) -> bytes:
+        if index not in results:
+            buffer = BytesIO()
+            img.save(
+                buffer,
+                format="JPEG",
+                quality=QUALITY_LEVELS[index],
+                optimize=True,
+                progressive=True,
+            )
+            results[index] = buffer.getvalue()
+        return results[index]
+
+    lo, hi = 0, len(QUALITY_LEVELS) - 1
+    best: Optional[int] = None
+    if hint in QUALITY_LEVELS:
+        index = QUALITY_LEVELS.index(hint)
+        if len(encode(index)) <= max_bytes:
+            best, lo = index, index + 1
+            if lo <= hi and len(encode(lo)) > max_bytes:
+                hi = index
+        else:
+            hi = index - 1
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if len(encode(mid)) <= max_bytes:
+            best, lo = mid, mid + 1
+        else:
+            hi = mid - 1
+    fits = best is not None
+    if best is None:
+        best = 0
+    data = encode(best)
+    quality = QUALITY_LEVELS[best]
+    if ALLOW_WEBP:
+        buffer = BytesIO()
+        img.save(buffer, format="WEBP", quality=quality, method=4)
+        if buffer.tell() < len(data):
+            data = buffer.getvalue()
+    save_timer.stop()
+    logger.debug(f"Encoded {len(data)} bytes at quality {quality}, tried {len(results)}")
+    return data, quality, fits
+
+
+FramePayload = Tuple[str, Tuple[int, int], bytes]  # (mode, size, 原始像素)
+QualityHints = Tuple[Optional[int], Optional[int]]  # (原图, 基准帧) 上次选中的质量
+
+
+class DecodedImage:
+    """
+    一张待发送的图片。
+
+    第一次需要特效时解码并缩放出基准帧，之后每个特效都在基准帧的副本上处理，
+    发送失败换特效重试时不必重复解码。基准帧也可以由 ``payload`` 直接还原，
+    用于在子进程之间传递，此时可以不提供 ``source``。
+    原图和基准帧大小不同，按大小编码时分别记住各自选中的质量。
+    """
+
+    def __init__(
+        self,
+        source: Optional[Union[Path, bytes]],
+        payload: Optional[FramePayload] = None,
+        key: Optional[int] = None,
+        qualities: QualityHints = (None, None),
+    ) -> None:
+        self.source = source
+        self.payload = payload
+        self.key = key  # 用于按 pid 记住按大小编码时选中的质量
+        self.source_quality, self.frame_quality = qualities
+        self._frame: Optional[Image.Image] = None
+
+    @property
+    def decoded(self) -> bool:
+        return self._frame is not None
+
+    @property
+    def qualities(self) -> QualityHints:
+        return self.source_quality, self.frame_quality
+
+    def base_frame(self) -> Image.Image:
+        if self._frame is None:
+            if self.payload is not None:
+                mode, size, data = self.payload
+                frame = Image.frombytes(mode, size, data)
+            else:
+                frame = image_param_converter(self.source)
+                if frame.mode not in ("RGB", "RGBA", "L"):
+                    frame = frame.convert("RGBA")
+                frame.load()
+            self._frame = frame
+        return self._frame.copy()
+
+    def export_payload(self) -> Optional[FramePayload]:
+        if self._frame is None:
+            return None
+        return (self._frame.mode, self._frame.size, self._frame.tobytes())
+
+    def _encode_frame(self, frame: Image.Image) -> bytes:
+        data, self.frame_quality, _ = encode_to_size(
+            frame, MAX_IMAGE_BYTES, self.frame_quality
+        )
+        return data
+
+    def render(self, effect_name: str) -> Union[Path, bytes]:
+        """应用名为 ``effect_name`` 的特效并编码"""
+        if effect_name != do_nothing.__name__:
+            frame = effect_func(effect_name)(self.base_frame())
+            if MAX_IMAGE_BYTES <= 0:
+                return encode_image(frame)
+            return self._encode_frame(frame)
+        # 不加特效时直接编码原图，保留原图的 JPEG 质量；原图放得下时总是直接发送
+        result = encode_image(self.source)
+        if MAX_IMAGE_BYTES <= 0 or not SEND_AS_BYTES or len(result) <= MAX_IMAGE_BYTES:
+            return result
+        source = Image.open(
+            self.source if isinstance(self.source, Path) else BytesIO(self.source)
+        )
+        data, self.source_quality, fits = encode_to_size(
+            source, MAX_IMAGE_BYTES, self.source_quality
+        )
+        if not fits:
+            # 原图以最低质量编码仍然太大，改用缩小后的图片
+            data = self._encode_frame(self.base_frame())
+        return data
+
+
+def render_effect(
+    source: Optional[Union[Path, bytes]],
+    effect_name: str,
+    payload: Optional[FramePayload] = None,
+    qualities: QualityHints = (None, None),
+) -> Tuple[Union[Path, bytes], Optional[FramePayload], QualityHints]:
+    """
+    在子进程中应用特效并编码。
+
+    本次新解码出基准帧时一并返回它的原始像素，下次重试时传回来即可跳过解码；
+    同时返回按大小编码时选中的质量。
+    """
+    image = DecodedImage(source, payload, qualities=qualities)
+    result = image.render(effect_name)
+    if payload is None and image.decoded:
+        return result, image.export_payload(), image.qualities
+    return result, None, image.qualities
 
 
 EFFECT_FUNC_LIST = [do_nothing, draw_frame, random_flip, random_lines, random_rotate]
+EFFECT_FUNCS = {func.__name__: func for func in EFFECT_FUNC_LIST}
+
+
+def effect_func(effect_name: str) -> Callable:
+    """按名称取特效函数，启用 ``setu_numpy_effects`` 且装有 numpy 时使用 NumPy 实现"""
+    if NUMPY_EFFECTS and effects_np is not None:
+        func = effects_np.EFFECT_FUNCS.get(effect_name)
+        if func is not None:
+            return func
+    return EFFECT_FUNCS[effect_name]
+
+
+def apply_effect_batch(
+    frames: List[Image.Image], effect_name: str
+) -> List[Image.Image]:
+    """
+    对一组已经缩放好的基准帧应用同一个特效。
+
+    装有 numpy 且特效有批量版本时，尺寸相同的帧叠成一个数组一次处理，
+    结果与逐张调用 NumPy 实现相同；否则逐张调用 ``effect_func``。
+    """
+    if effects_np is not None and effect_name in effects_np.BATCH_FUNCS:
+        return effects_np.BATCH_FUNCS[effect_name](frames)
+    func = effect_func(effect_name)
+    return [func(frame) for frame in frames]
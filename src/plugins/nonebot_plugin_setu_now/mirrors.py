@@ -0,0 +1,179 @@
+import time
+import random
+import asyncio
+from typing import Set, Dict, List, Deque, Optional
+from collections import deque
+from urllib.parse import urlsplit
+
+from httpx import Response, AsyncClient
+from nonebot.log import logger
+
+from .config import REVERSE_PROXY, HEDGE_REQUESTS, REVERSE_PROXY_MIRRORS
+
+
+class MirrorStats:
+    __slots__ = ("latencies", "outcomes")
+
+    def __init__(self, window: int) -> None:
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(q * (len(ordered) - 1))]
+
+
+class MirrorSelector:
+    """
+    在多个反代镜像之间选择图片下载地址。
+
+    按最近 ``window`` 次请求的响应头延迟中位数和错误率给镜像打分，优先使用最快的健康镜像，
+    请求失败时依次换用后面的镜像；开启 ``hedge`` 时，若首个请求超过该镜像 p90 延迟仍未响应，则向次优镜像再发一个请求，
+    取先成功的一个。
+    """
+
+    MIN_SAMPLES = 10  # 样本不足时不计算 p90，也就不发对冲请求
+    ERROR_PENALTY = 10.0
+    FAILURE_LATENCY = 15.0  # 没有成功样本的镜像按下载超时计
+    EXPLORE_RATE = 0.05  # 偶尔打乱顺序，让暂时落后的镜像有机会恢复
+
+    def __init__(
+        self, origin: str, mirrors: List[str], hedge: bool, window: int = 50
+    ) -> None:
+        # API 返回的图片地址使用 origin 作为反代，下载时换成选中的镜像
+        self.origin = origin
+        self.mirrors = mirrors or [origin]
+        self.hedge = hedge and len(self.mirrors) > 1
+        self._stats: Dict[str, MirrorStats] = {
+            m: MirrorStats(window) for m in self.mirrors
+        }
+
+    def _score(self, mirror: str) -> float:
+        stats = self._stats[mirror]
+        if not stats.outcomes:
+            return 0.0
+        latency = stats.quantile(0.5) or self.FAILURE_LATENCY
+        return latency * (1 + self.ERROR_PENALTY * stats.error_rate)
+
+    def candidates(self, url: str) -> List[str]:
+        """返回按优先级排好的下载地址，不是反代地址时原样返回"""
+        parts = urlsplit(url)
+        if len(self.mirrors) < 2 or (
+            parts.netloc != self.origin and parts.netloc not in self._stats
+        ):
+            return [url]
+        if random.random() < self.EXPLORE_RATE:
+            mirrors = random.sample(self.mirrors, len(self.mirrors))
+        else:
+            mirrors = sorted(self.mirrors, key=self._score)
+        return [parts._replace(netloc=m).geturl() for m in mirrors]
+
+    def record(self, url: str, latency: Optional[float]) -> None:
+        """记录一次请求结果，``latency`` 为 None 表示失败"""
+        stats = self._stats.get(urlsplit(url).netloc)
+        if stats is None:
+            return
+        stats.outcomes.append(latency is not None)
+        if latency is not None:
+            stats.latencies.append(latency)
+
+    def hedge_delay(self, url: str) -> Optional[float]:
+        if not self.hedge:
+            return None
+        stats = self._stats.get(urlsplit(url).netloc)
+        if stats is None or len(stats.latencies) < self.MIN_SAMPLES:
+            return None
+        return stats.quantile(0.9)
+
+    async def _send(
+        self, client: AsyncClient, url: str, headers: Dict[str, str], timeout: float
+    ) -> Response:
+        start = time.monotonic()
+        try:
+            request = client.build_request("GET", url, headers=headers, timeout=timeout)
+            response = await client.send(request, stream=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.record(url, None)
+            raise
+        if response.status_code != 200:
+            await response.aclose()
+            self.record(url, None)
+            logger.warning(f"Image respond status code error: {response.status_code}")
+            raise ValueError(f"Image respond status code error: {response.status_code}")
+        self.record(url, time.monotonic() - start)
+        return response
+
+    async def open_stream(
+        self,
+        client: AsyncClient,
+        urls: List[str],
+        headers: Dict[str, str],
+        timeout: float,
+    ) -> Response:
+        """
+        以流式方式依次尝试 ``urls``，请求失败时换下一个地址；开启对冲时首个请求超过 p90 延迟
+        仍未响应，则提前向下一个地址发请求，取先成功的一个。
+        返回的响应需要调用方关闭。
+        """
+        candidates = iter(urls)
+        pending: Set[asyncio.Task] = set()
+
+        def launch() -> bool:
+            url = next(candidates, None)
+            if url is None:
+                return False
+            pending.add(asyncio.create_task(self._send(client, url, headers, timeout)))
+            return True
+
+        launch()
+        delay = self.hedge_delay(urls[0]) if len(urls) > 1 else None
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                # 对冲请求只发一次
+                delay = None
+                if not done:
+                    launch()
+                    logger.debug("Hedging image request")
+                    continue
+                pending.difference_update(done)
+                winner: Optional[Response] = None
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        _close_response(task)
+                if winner is not None:
+                    return winner
+                if not pending and launch():
+                    logger.debug(f"Image request failed, trying next mirror: {error}")
+            assert error is not None
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(_close_response)
+
+
+def _close_response(task: "asyncio.Task[Response]") -> None:
+    """关闭对冲中落败但已经拿到响应的请求"""
+    if not task.cancelled() and task.exception() is None:
+        asyncio.create_task(task.result().aclose())
+
+
+MIRROR_SELECTOR = MirrorSelector(REVERSE_PROXY, REVERSE_PROXY_MIRRORS, HEDGE_REQUESTS)
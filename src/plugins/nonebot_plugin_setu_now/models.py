@@ -1,4 +1,4 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Union, Optional
 from pathlib import Path
 
 
@@ -36,12 +36,13 @@ class Setu:
         self.p: int = data.p
         self.r18: bool = data.r18
         self.ext: str = data.ext
-        self.img: Optional[Path] = None
+        self.img: Optional[Union[Path, bytes]] = None
         self.msg: Optional[str] = None
         self.is_local: bool = False
+        self.dhash: Optional[int] = None
 
     @staticmethod
-    def local_setu(path: Path) -> "Setu":
+    def local_setu(path: Union[Path, bytes]) -> "Setu":
         """
         Create a Setu instance for a local image.
         """
@@ -0,0 +1,119 @@
+import asyncio
+from typing import Dict, List, Deque, Tuple, Callable, Optional, Awaitable
+from pathlib import Path
+from collections import deque
+
+from PIL import Image
+from nonebot.log import logger
+
+from .utils import download_pic
+from .config import PROXY, SETU_PATH, SETU_SIZE
+from .models import Setu
+from .file_cache import IMAGE_CACHE, discard_image
+from .dedupe import DEDUPE_INDEX, fetch_dhash
+
+PoolKey = Tuple[bool, bool]  # (r18, excludeAI)
+
+
+def verify_image(path: Path) -> bool:
+    try:
+        with Image.open(path) as img:
+            img.verify()
+    except Exception:
+        return False
+    return True
+
+
+class PrefetchPool:
+    """
+    为不带关键词和标签的请求预先下载并校验好图片，按 (r18, excludeAI) 分桶。
+    图片被取走后在后台补充，每次向 API 请求 ``BATCH`` 张。
+    启用去重时在后台顺便下载缩略图算出感知哈希，取图时不必再等待缩略图。
+    """
+
+    BATCH = 20
+
+    def __init__(
+        self,
+        size: int,
+        fetch: Callable[[bool, bool, int], Awaitable[List[Setu]]],
+    ) -> None:
+        self.size = size
+        self.fetch = fetch
+        self._pools: Dict[PoolKey, Deque[Setu]] = {}
+        self._refill_tasks: Dict[PoolKey, asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def take(self, r18: bool, excludeAI: bool, num: int) -> List[Setu]:
+        if not self.enabled:
+            return []
+        pool = self._pools.setdefault((r18, excludeAI), deque())
+        result: List[Setu] = []
+        while pool and len(result) < num:
+            setu = pool.popleft()
+            # 同一 pid 的其他请求发送后可能已经删除了文件
+            if setu.img is not None and Path(setu.img).exists():
+                result.append(setu)
+        self.schedule_refill(r18, excludeAI)
+        return result
+
+    def schedule_refill(self, r18: bool, excludeAI: bool) -> None:
+        if not self.enabled:
+            return
+        key = (r18, excludeAI)
+        task = self._refill_tasks.get(key)
+        if task is None or task.done():
+            self._refill_tasks[key] = asyncio.create_task(self._refill(key))
+
+    async def _prepare(self, setu: Setu) -> Optional[Setu]:
+        setu.img = await download_pic(
+            url=setu.urls[SETU_SIZE],
+            proxy=PROXY,
+            file_mode=True,
+            file_name=f"{setu.pid}.{setu.ext}",
+        )
+        if setu.img is None:
+            return None
+        if not await asyncio.to_thread(verify_image, setu.img):
+            logger.warning(f"Prefetched image {setu.pid} is broken, dropped")
+            discard_image(Path(setu.img))
+            return None
+        if DEDUPE_INDEX.enabled:
+            # 与 API 结果一样用缩略图计算，两条路径得到的哈希才能互相比较
+            setu.dhash = await fetch_dhash(setu, PROXY)
+        return setu
+
+    async def _refill(self, key: PoolKey) -> None:
+        r18, excludeAI = key
+        pool = self._pools.setdefault(key, deque())
+        while len(pool) < self.size:
+            try:
+                setu_list = await self.fetch(r18, excludeAI, self.BATCH)
+            except Exception as e:
+                logger.warning(f"Prefetch {key} failed: {e}")
+                return
+            setu_list = setu_list[: self.size - len(pool)]
+            ready = [
+                setu
+                for setu in await asyncio.gather(*map(self._prepare, setu_list))
+                if setu is not None
+            ]
+            if not ready:
+                return
+            pool.extend(ready)
+            logger.debug(f"Prefetch pool {key}: {len(pool)}/{self.size}")
+
+    async def aclose(self) -> None:
+        for task in self._refill_tasks.values():
+            task.cancel()
+        self._refill_tasks.clear()
+        if IMAGE_CACHE is None and SETU_PATH is None:
+            # 未启用图片缓存时图片只是临时文件
+            for pool in self._pools.values():
+                for setu in pool:
+                    if setu.img is not None:
+                        Path(setu.img).unlink(missing_ok=True)
+        self._pools.clear()
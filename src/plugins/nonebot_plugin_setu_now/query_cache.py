@@ -0,0 +1,100 @@
+import time
+from typing import List, Tuple, Deque, Callable, Optional, Awaitable
+from collections import deque, OrderedDict
+
+from nonebot.log import logger
+
+from .models import Setu, SetuNotFindError
+
+QueryKey = Tuple[str, Tuple[Tuple[str, ...], ...], bool, bool]
+
+
+class _Entry:
+    __slots__ = ("results", "expires_at")
+
+    def __init__(self, results: Deque[Setu], expires_at: float) -> None:
+        self.results = results  # 为空表示 API 没有结果
+        self.expires_at = expires_at
+
+
+class QueryCache:
+    """
+    按 (key, tags, r18, excludeAI) 缓存 lolicon API 的查询结果。
+
+    每次向 API 多要 ``BATCH`` 张，之后的相同查询从剩余结果中依次取出；
+    没有结果的查询在 ``negative_ttl`` 秒内直接判定为没有结果。
+    条目数超过 ``max_entries`` 时淘汰最久未使用的查询。
+    """
+
+    BATCH = 20  # lolicon API 单次最多返回 20 张
+
+    def __init__(
+        self,
+        fetch: Callable[[str, List[List[str]], bool, int, bool], Awaitable[List[Setu]]],
+        ttl: int,
+        negative_ttl: int,
+        max_entries: int,
+    ) -> None:
+        self.fetch_func = fetch
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[QueryKey, _Entry]" = OrderedDict()
+
+    @staticmethod
+    def make_key(
+        key: str, tags: Optional[List[List[str]]], r18: Optional[bool], excludeAI: bool
+    ) -> QueryKey:
+        # 没有标签或不是 R18 请求时处理器传入的是 None
+        return (key or "", tuple(tuple(tag) for tag in tags or []), bool(r18), excludeAI)
+
+    def _get(self, qkey: QueryKey) -> Optional[_Entry]:
+        entry = self._entries.get(qkey)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            del self._entries[qkey]
+            return None
+        self._entries.move_to_end(qkey)
+        return entry
+
+    def _put(self, qkey: QueryKey, results: List[Setu], ttl: int) -> None:
+        if ttl <= 0:
+            return
+        self._entries[qkey] = _Entry(deque(results), time.monotonic() + ttl)
+        self._entries.move_to_end(qkey)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def fetch(
+        self, key: str, tags: List[List[str]], r18: bool, num: int, excludeAI: bool = False
+    ) -> List[Setu]:
+        qkey = self.make_key(key, tags, r18, excludeAI)
+        entry = self._get(qkey)
+        result: List[Setu] = []
+        if entry is not None:
+            if not entry.results:
+                logger.debug(f"Query cache negative hit: {qkey}")
+                raise SetuNotFindError()
+            while entry.results and len(result) < num:
+                result.append(entry.results.popleft())
+            logger.debug(f"Query cache hit: {qkey}, {len(result)} image")
+            if not entry.results:
+                del self._entries[qkey]
+        if len(result) >= num:
+            return result
+
+        need = num - len(result)
+        try:
+            fetched = await self.fetch_func(
+                key, tags, r18, max(need, self.BATCH if self.ttl > 0 else need), excludeAI
+            )
+        except SetuNotFindError:
+            if result:
+                return result
+            self._put(qkey, [], self.negative_ttl)
+            raise
+        result += fetched[:need]
+        if rest := fetched[need:]:
+            self._put(qkey, rest, self.ttl)
+        return result
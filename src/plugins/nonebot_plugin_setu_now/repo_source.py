@@ -0,0 +1,97 @@
+import time
+import random
+import asyncio
+from typing import Dict, List, Union, Optional
+from pathlib import Path
+
+from nonebot.log import logger
+
+from .utils import download_pic
+from .config import REPO_LIST_TTL, REPO_BASE_URL, DOWNLOAD_TO_MEMORY
+from .http_client import CLIENT_MANAGER
+
+
+class RepoSource:
+    """
+    本地图库 (``setu_repo_base_url``) 的图片来源。
+
+    图片列表在内存中缓存 ``ttl`` 秒，过期后带 ETag / Last-Modified 向图库重新验证，
+    列表未变化时图库只需返回 304。已经在图片缓存中的图片不会重复下载。
+    刷新失败后按指数退避等待，最长 ``ttl`` 秒（至少 ``RETRY_DELAY`` 秒），期间不再请求图库。
+    """
+
+    RETRY_DELAY = 5
+
+    def __init__(self, base_url: str, ttl: int) -> None:
+        self.base_url = base_url
+        self.ttl = ttl
+        self._images: List[str] = []
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+        self._expires_at = 0.0
+        self._failures = 0
+        self._lock = asyncio.Lock()
+
+    async def _refresh(self) -> None:
+        async with self._lock:
+            # 等待锁期间可能已经被其他请求刷新过
+            if time.monotonic() < self._expires_at:
+                return
+            headers: Dict[str, str] = {}
+            if self._images:
+                if self._etag:
+                    headers["If-None-Match"] = self._etag
+                if self._last_modified:
+                    headers["If-Modified-Since"] = self._last_modified
+            try:
+                client = CLIENT_MANAGER.get()
+                response = await client.get(
+                    f"{self.base_url}/list_images", headers=headers
+                )
+                if response.status_code == 304:
+                    logger.debug("Image list not modified")
+                elif response.status_code == 200:
+                    self._images = response.json()["images"]
+                    self._etag = response.headers.get("ETag")
+                    self._last_modified = response.headers.get("Last-Modified")
+                    logger.debug(f"Image list refreshed: {len(self._images)} images")
+                else:
+                    raise ValueError(
+                        f"Image list respond status code error: {response.status_code}"
+                    )
+            except Exception:
+                self._backoff()
+                raise
+            self._failures = 0
+            self._expires_at = time.monotonic() + self.ttl
+
+    def _backoff(self) -> None:
+        delay = min(
+            max(self.ttl, self.RETRY_DELAY), self.RETRY_DELAY * 2**self._failures
+        )
+        self._failures += 1
+        self._expires_at = time.monotonic() + delay
+
+    async def fetch(self, user_id: str = "") -> Optional[Union[Path, bytes]]:
+        if time.monotonic() >= self._expires_at:
+            try:
+                await self._refresh()
+            except Exception as e:
+                if not self._images:
+                    logger.error(f"Fetch local image failed: {e}")
+                    return None
+                logger.warning(f"Refresh image list failed, using cached list: {e}")
+        if not self._images:
+            logger.error("Fetch local image failed: image list is empty")
+            return None
+        image_name = random.choice(self._images)
+        return await download_pic(
+            url=f"{self.base_url}/original/{image_name}",
+            file_mode=True,
+            file_name=image_name,
+            to_memory=DOWNLOAD_TO_MEMORY,
+            user_id=user_id,
+        )
+
+
+REPO_SOURCE = RepoSource(REPO_BASE_URL, REPO_LIST_TTL)
@@ -0,0 +1,129 @@
+import time
+import asyncio
+from typing import Dict, Deque, Optional, AsyncIterator
+from contextlib import asynccontextmanager
+from collections import deque, defaultdict
+from urllib.parse import urlsplit
+
+from .config import DOWNLOAD_PER_HOST, DOWNLOAD_BANDWIDTH, DOWNLOAD_CONCURRENCY
+
+
+class _Waiter:
+    __slots__ = ("host", "future")
+
+    def __init__(self, host: str, future: "asyncio.Future[None]") -> None:
+        self.host = host
+        self.future = future
+
+
+class TokenBucket:
+    """按字节计的令牌桶，最多允许突发 1 秒的流量"""
+
+    def __init__(self, rate: int) -> None:
+        self.rate = rate
+        self._tokens = float(rate)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def consume(self, amount: int) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                float(self.rate), self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            self._tokens -= amount
+            # 令牌不足时在持有锁的情况下等待，后来的下载按顺序排队
+            if self._tokens < 0:
+                await asyncio.sleep(-self._tokens / self.rate)
+
+
+class DownloadScheduler:
+    """
+    插件全局的图片下载调度。
+
+    同时进行的下载不超过 ``concurrency`` 个，对同一主机不超过 ``per_host`` 个；
+    排队的下载按用户轮流放行，一个用户的大批量请求不会挤占其他用户。
+    ``bandwidth`` 大于 0 时所有下载共享每秒 ``bandwidth`` 字节的带宽。
+    """
+
+    def __init__(self, concurrency: int, per_host: int, bandwidth: int = 0) -> None:
+        self.concurrency = max(1, concurrency)
+        self.per_host = max(1, per_host)
+        self._bucket = TokenBucket(bandwidth) if bandwidth > 0 else None
+        self._running = 0
+        self._host_running: Dict[str, int] = defaultdict(int)
+        self._queues: Dict[str, Deque[_Waiter]] = {}
+        self._users: Deque[str] = deque()
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        for _ in range(len(self._users)):
+            user_id = self._users[0]
+            self._users.rotate(-1)
+            queue = self._queues[user_id]
+            for waiter in queue:
+                if self._host_running[waiter.host] < self.per_host:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[user_id]
+                        self._users.remove(user_id)
+                    return waiter
+        return None
+
+    def _dispatch(self) -> None:
+        while self._running < self.concurrency:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self._running += 1
+            self._host_running[waiter.host] += 1
+            waiter.future.set_result(None)
+
+    def _release(self, host: str) -> None:
+        self._running -= 1
+        self._host_running[host] -= 1
+        if not self._host_running[host]:
+            del self._host_running[host]
+        self._dispatch()
+
+    def _remove(self, user_id: str, waiter: _Waiter) -> None:
+        queue = self._queues.get(user_id)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[user_id]
+            self._users.remove(user_id)
+
+    @asynccontextmanager
+    async def slot(self, url: str, user_id: str = "") -> AsyncIterator[None]:
+        """排队等待一个下载名额，``async with`` 结束时归还"""
+        host = urlsplit(url).netloc
+        waiter = _Waiter(host, asyncio.get_running_loop().create_future())
+        if user_id not in self._queues:
+            self._queues[user_id] = deque()
+            self._users.append(user_id)
+        self._queues[user_id].append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 已经分到名额后才被取消
+                self._release(host)
+            else:
+                self._remove(user_id, waiter)
+            raise
+        try:
+            yield
+        finally:
+            self._release(host)
+
+    async def throttle(self, amount: int) -> None:
+        if self._bucket is not None:
+            await self._bucket.consume(amount)
+
+
+DOWNLOAD_SCHEDULER = DownloadScheduler(
+    DOWNLOAD_CONCURRENCY, DOWNLOAD_PER_HOST, DOWNLOAD_BANDWIDTH
+)
@@ -1,54 +1,176 @@
+import os
 import time
 import asyncio
-from typing import List, Optional
+import tempfile
+from typing import IO, Set, List, Tuple, Union, Optional
 from pathlib import Path
 
 import nonebot_plugin_localstore as store
-from httpx import AsyncClient
+from httpx import Response
 from nonebot.log import logger
 from nonebot.adapters.onebot.v11 import Bot, Message, GroupMessageEvent
 
-from .config import SETU_PATH, SEND_INTERVAL, REPO_BASE_URL
+from .config import SETU_PATH, SEND_INTERVAL
 from .perf_timer import PerfTimer
-import random
+from .http_client import CLIENT_MANAGER
+from .file_cache import IMAGE_CACHE, FileCache
+from .scheduler import DOWNLOAD_SCHEDULER
+from .mirrors import MIRROR_SELECTOR
+
+
+WRITE_BUFFER_SIZE = 256 * 1024  # 攒够这么多字节再交给线程写盘
+
+# 持有后台写盘任务的引用，避免任务在完成前被回收
+_background_writes: Set[asyncio.Task] = set()
+
+
+def _open_part(image_path: Path) -> Tuple[IO[bytes], Path]:
+    """在同一目录下创建唯一的临时文件，同名图片的并发下载互不干扰"""
+    fd, name = tempfile.mkstemp(
+        prefix=f"{image_path.name}.", suffix=".part", dir=image_path.parent
+    )
+    try:
+        # mkstemp 创建的文件只有属主可读，改回普通文件的权限，OneBot 实现才能读取
+        os.chmod(name, 0o644)
+        return os.fdopen(fd, "wb"), Path(name)
+    except BaseException:
+        os.close(fd)
+        os.unlink(name)
+        raise
+
+
+def _write_image(image_path: Path, data: bytes) -> None:
+    f, part_path = _open_part(image_path)
+    try:
+        with f:
+            f.write(data)
+        os.replace(part_path, image_path)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+
+
+async def _save_image(
+    image_path: Path, data: bytes, cache: Optional[FileCache]
+) -> None:
+    try:
+        await asyncio.to_thread(_write_image, image_path, data)
+    except OSError as e:
+        logger.warning(f"Save image failed: {image_path.name}: {e}")
+        return
+    if cache is not None:
+        cache.add(image_path.name)
+
+
+def save_in_background(
+    image_path: Path, data: bytes, cache: Optional[FileCache] = None
+) -> None:
+    """在后台线程中写入图片，写完后登记到 ``cache``"""
+    task = asyncio.create_task(_save_image(image_path, data, cache))
+    _background_writes.add(task)
+    task.add_done_callback(_background_writes.discard)
+
+
+async def _stream_to_file(response: Response, f: IO[bytes]) -> None:
+    """边下载边写盘，文件操作都在线程中进行，不阻塞事件循环"""
+    try:
+        pending = bytearray()
+        async for chunk in response.aiter_bytes():
+            pending += chunk
+            if len(pending) >= WRITE_BUFFER_SIZE:
+                await asyncio.to_thread(f.write, pending)
+                pending.clear()
+            await DOWNLOAD_SCHEDULER.throttle(len(chunk))
+        if pending:
+            await asyncio.to_thread(f.write, pending)
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+async def wait_background_writes() -> None:
+    """等待所有后台写盘任务完成"""
+    if _background_writes:
+        await asyncio.gather(*_background_writes, return_exceptions=True)
 
 
 async def download_pic(
-    url: str, proxy: Optional[str] = None, file_mode=False, file_name=""
-) -> Optional[Path]:
+    url: str,
+    proxy: Optional[str] = None,
+    file_mode=False,
+    file_name="",
+    to_memory=False,
+    user_id: str = "",
+    cache=True,
+) -> Optional[Union[Path, bytes]]:
+    """
+    下载图片。
+
+    ``to_memory`` 为真时图片直接下载到内存并返回 bytes，
+    仅在启用了图片缓存或设置了 ``setu_path`` 时才在后台写入磁盘；
+    缓存命中时仍然返回缓存文件的路径；下载到内存且 ``cache`` 为假时既不读取也不写入缓存。
+    下载经由 ``DOWNLOAD_SCHEDULER`` 排队，``user_id`` 用于在用户之间轮流放行；
+    反代地址由 ``MIRROR_SELECTOR`` 换成当前最快的镜像。
+    """
     headers = {
         "Referer": "https://accounts.pixiv.net/login?lang=zh&source=pc&view_type=page&ref=wwwtop_accounts_index",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; WOW64) "
         "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36",
     }
-    download_timer = PerfTimer.start("Image download")
-    image_path = (
-        store.get_cache_file("nonebot_plugin_setu_now", file_name)
-        if SETU_PATH is None
-        else Path(SETU_PATH, file_name)
-    )
-    client = AsyncClient(proxy=proxy, timeout=5)
+    if IMAGE_CACHE is not None:
+        if cache and (cached_path := IMAGE_CACHE.get(file_name)):
+            logger.debug(f"Image cache hit: {file_name}")
+            return cached_path
+        image_path = IMAGE_CACHE.path(file_name)
+    elif SETU_PATH is None:
+        image_path = store.get_cache_file("nonebot_plugin_setu_now", file_name)
+    else:
+        image_path = Path(SETU_PATH, file_name)
+    client = CLIENT_MANAGER.get(proxy)
+    buffer = bytearray() if to_memory else None
+    # 先写入临时文件，下载完成后再原子地替换，半截文件不会被当作缓存
+    part_path: Optional[Path] = None
+    urls = MIRROR_SELECTOR.candidates(url)
     try:
-        async with client.stream(
-            method="GET", url=url, headers=headers, timeout=15
-        ) as response:
-            if response.status_code != 200:
-                logger.warning(
-                    f"Image respond status code error: {response.status_code}"
-                )
-                raise ValueError(
-                    f"Image respond status code error: {response.status_code}"
+        async with DOWNLOAD_SCHEDULER.slot(urls[0], user_id):
+            download_timer = PerfTimer.start("Image download")
+            try:
+                response = await MIRROR_SELECTOR.open_stream(
+                    client, urls, headers, timeout=15
                 )
-            with open(image_path, "wb") as f:
-                async for chunk in response.aiter_bytes():
-                    f.write(chunk)
-    except Exception:
+                try:
+                    if buffer is not None:
+                        async for chunk in response.aiter_bytes():
+                            buffer += chunk
+                            await DOWNLOAD_SCHEDULER.throttle(len(chunk))
+                    else:
+                        f, part_path = await asyncio.to_thread(_open_part, image_path)
+                        await _stream_to_file(response, f)
+                finally:
+                    await response.aclose()
+            finally:
+                download_timer.stop()
+    except BaseException as e:
+        if part_path is not None:
+            # 被取消时同样删除临时文件，不能等待线程，直接在这里删除
+            part_path.unlink(missing_ok=True)
+        if not isinstance(e, Exception):
+            raise
         logger.warning(f"Image download failed: {url}")
         return None
-    finally:
-        await client.aclose()
-        download_timer.stop()
-    logger.info(type(image_path))
+    if buffer is not None:
+        data = bytes(buffer)
+        if cache and (IMAGE_CACHE is not None or SETU_PATH is not None):
+            save_in_background(image_path, data, IMAGE_CACHE)
+        return data
+    assert part_path is not None
+    try:
+        await asyncio.to_thread(os.replace, part_path, image_path)
+    except OSError as e:
+        logger.warning(f"Save image failed: {image_path.name}: {e}")
+        await asyncio.to_thread(part_path.unlink, missing_ok=True)
+        return None
+    if IMAGE_CACHE is not None:
+        IMAGE_CACHE.add(file_name)
     return image_path
 
 
@@ -93,24 +215,3 @@ class SpeedLimiter:
             logger.debug(f"Speed limit: Asyncio sleep {delay_time}s")
             await asyncio.sleep(delay_time)
 
-
-async def fetch_local_pic():
-    client = AsyncClient(timeout=5)
-    image_list_url = f"{REPO_BASE_URL}/list_images"
-    image_url = f"{REPO_BASE_URL}/original/"
-    try:
-        response = await client.get(image_list_url)
-        if response.status_code != 200:
-            raise ValueError(
-                f"Image list respond status code error: {response.status_code}"
-            )
-        image_list = response.json()['images']
-        random_image_name = random.choice(image_list)
-        image_url = image_url + random_image_name
-        image_path = await download_pic(
-            url=image_url, file_mode=True, file_name=random_image_name
-        )
-        return image_path
-    except Exception as e:
-        logger.error(f"Fetch local image failed: {e}")
-        return None
\ No newline at end of file
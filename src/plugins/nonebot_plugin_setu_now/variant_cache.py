@@ -0,0 +1,48 @@
+import asyncio
+from typing import Callable, Optional
+from pathlib import Path
+
+import nonebot_plugin_localstore as store
+
+from .utils import save_in_background
+from .config import SETU_SIZE, VARIANT_CACHE_MAX_BYTES
+from .models import Setu
+from .img_utils import do_nothing
+from .file_cache import FileCache
+
+# 加过特效并编码好的图片，与原图缓存分开计算容量
+VARIANT_CACHE: Optional[FileCache] = (
+    FileCache(
+        Path(store.get_cache_dir("nonebot_plugin_setu_now")) / "variants",
+        VARIANT_CACHE_MAX_BYTES,
+    )
+    if VARIANT_CACHE_MAX_BYTES > 0
+    else None
+)
+
+
+def variant_name(setu: Setu, effect: Callable) -> Optional[str]:
+    """按 (pid, p, size, effect) 生成缓存文件名，不需要缓存时返回 None"""
+    if VARIANT_CACHE is None or setu.is_local or effect is do_nothing:
+        return None
+    return f"{setu.pid}_p{setu.p}_{SETU_SIZE}_{effect.__name__}.jpg"
+
+
+async def load_variant(name: Optional[str]) -> Optional[bytes]:
+    if VARIANT_CACHE is None or name is None:
+        return None
+    path = VARIANT_CACHE.get(name)
+    if path is None:
+        return None
+    try:
+        return await asyncio.to_thread(path.read_bytes)
+    except OSError:
+        VARIANT_CACHE.discard(name)
+        return None
+
+
+def store_variant(name: Optional[str], data: bytes) -> None:
+    """保存发送成功的图片，写盘在后台进行"""
+    if VARIANT_CACHE is None or name is None:
+        return
+    save_in_background(VARIANT_CACHE.path(name), data, VARIANT_CACHE)
@@ -0,0 +1,79 @@
+"""
+预取池与 API 结果必须用同一张缩略图计算感知哈希，否则同一 pid 在两条路径上的哈希不同，
+去重会漏掉从另一条路径回来的图片。
+
+    python -m pytest tests
+"""
+import sys
+import types
+import asyncio
+import importlib
+from io import BytesIO
+from pathlib import Path
+
+import nonebot
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parent.parent
+PACKAGE = "src.plugins.nonebot_plugin_setu_now"
+
+
+def load_module(name: str):
+    # 不执行插件的 __init__（需要完整的 bot 环境），只加载用到的模块
+    nonebot.init()
+    for package in ("src", "src.plugins", PACKAGE):
+        if package not in sys.modules:
+            module = types.ModuleType(package)
+            module.__path__ = [str(ROOT.joinpath(*package.split(".")))]
+            sys.modules[package] = module
+    return importlib.import_module(f"{PACKAGE}.{name}")
+
+
+def encode(img: Image.Image) -> bytes:
+    buffer = BytesIO()
+    img.save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def test_prefetch_and_api_hash_the_same_thumbnail(tmp_path, monkeypatch):
+    dedupe = load_module("dedupe")
+    prefetch = load_module("prefetch")
+    models = load_module("models")
+
+    # 原图与缩略图内容不同（缩略图是正方形裁切），哈希只能来自缩略图
+    original = Image.effect_mandelbrot((300, 200), (-2.2, -1, 0.8, 1), 100).convert("RGB")
+    thumbnail = original.crop((50, 0, 250, 200)).resize((48, 48))
+    original_path = tmp_path / "1.jpg"
+    original_path.write_bytes(encode(original))
+    thumbnail_data = encode(thumbnail)
+
+    async def fake_download(url, *args, **kwargs):
+        return thumbnail_data if url.endswith("_mini.jpg") else original_path
+
+    monkeypatch.setattr(dedupe, "download_pic", fake_download)
+    monkeypatch.setattr(prefetch, "download_pic", fake_download)
+    monkeypatch.setattr(prefetch.DEDUPE_INDEX, "window", 60)
+
+    def make_setu():
+        return models.Setu(
+            models.SetuData(
+                pid=1, p=0, uid=0, title="", author="", r18=False, width=300,
+                height=200, tags=[], ext="jpg", aiType=0, uploadDate=0,
+                urls={
+                    prefetch.SETU_SIZE: "http://i/1_regular.jpg",
+                    dedupe.HASH_SIZE: "http://i/1_mini.jpg",
+                },
+            )
+        )
+
+    async def hashes():
+        from_api = await dedupe.fetch_dhash(make_setu(), None)
+        pool = prefetch.PrefetchPool(1, None)
+        prefetched = await pool._prepare(make_setu())
+        return from_api, prefetched.dhash
+
+    from_api, from_prefetch = asyncio.run(hashes())
+    assert from_api is not None
+    assert from_api == from_prefetch == dedupe.dhash(thumbnail_data)
+    # 用原图计算会得到明显不同的哈希，这正是两条路径必须一致的原因
+    assert dedupe.hamming(from_api, dedupe.dhash(original_path.read_bytes())) > 6